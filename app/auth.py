@@ -1,25 +1,135 @@
+import asyncio
+import hmac
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 from fastapi import Depends, HTTPException
-from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
-from . import models, database
+from fastapi.security import APIKeyHeader, OAuth2PasswordBearer
+from jose import jwt, JWTError
+from passlib.context import CryptContext
+from . import models, schemas, config
+from .lru import LRUCache
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+ingest_key_header = APIKeyHeader(name="X-Ingest-Key", auto_error=False)
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(database.get_session_local)):
-    if not token:
-        raise HTTPException(status_code=401, detail="Authentication required")
+# Verified claims keyed by the raw token string
+token_cache = LRUCache(maxsize=config.TOKEN_CACHE_SIZE)
 
-    # For debugging
-    print(f"Received token: {token}")
+def _build_password_context() -> CryptContext:
+    # Other schemes stay verifiable so switching PASSWORD_HASH_SCHEME doesn't lock
+    # anyone out; "plaintext" matches the legacy unhashed rows. Everything but the
+    # configured scheme is deprecated, so those hashes are replaced on login.
+    scheme = config.PASSWORD_HASH_SCHEME
+    schemes = [scheme] + [other for other in ("bcrypt", "argon2", "pbkdf2_sha256") if other != scheme] + ["plaintext"]
+    settings = {}
+    if config.PASSWORD_HASH_ROUNDS:
+        settings[f"{scheme}__default_rounds"] = config.PASSWORD_HASH_ROUNDS
+        settings[f"{scheme}__min_rounds"] = config.PASSWORD_HASH_ROUNDS
+    return CryptContext(schemes=schemes, default=scheme, deprecated="auto", **settings)
+
+pwd_context = _build_password_context()
+
+
+class PasswordHasher:
+    """Runs passlib hashing on a bounded thread pool so slow hashes don't block the event loop"""
+
+    def __init__(self, context: CryptContext, workers: int, max_pending: int):
+        self.context = context
+        self.max_pending = max_pending
+        self.pending = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hash")
+        self._dummy_hash = None
+
+    async def _run(self, func, *args):
+        # Only touched from the event loop, so the counter needs no lock
+        if self.pending >= self.max_pending:
+            raise HTTPException(status_code=503, detail="Too many logins in progress", headers={"Retry-After": "1"})
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        finally:
+            self.pending -= 1
+
+    async def hash(self, password: str) -> str:
+        return await self._run(self.context.hash, password)
+
+    async def verify_and_update(self, password: str, hashed: Optional[str]) -> tuple[bool, Optional[str]]:
+        """Check a password; the second item is a replacement hash when the stored one is outdated"""
+        if hashed is None:
+            # Unknown user: spend the same time as a real check so usernames can't be probed
+            if self._dummy_hash is None:
+                self._dummy_hash = await self.hash("dummy-password")
+            await self._run(self.context.verify, password, self._dummy_hash)
+            return False, None
+        return await self._run(self.context.verify_and_update, password, hashed)
 
-    # Change this to match the token format from your login endpoint
-    user = db.query(models.User).filter(models.User.username == "admin").first()
-    if user is None:
-        raise HTTPException(status_code=401, detail="Invalid credentials")
-    return user
 
-def get_current_admin(token: str = Depends(oauth2_scheme), db: Session = Depends(database.get_session_local)):
-    user = get_current_user(token, db)
+password_hasher = PasswordHasher(pwd_context, config.PASSWORD_HASH_WORKERS, config.PASSWORD_HASH_MAX_PENDING)
+
+# Placeholder shipped in earlier versions of config.py; public, so never accepted
+_PUBLIC_SECRET_KEYS = {"", "change-me-in-production"}
+
+def signing_key() -> str:
+    """The configured SECRET_KEY; raises if it is unset or a known public value"""
+    if config.SECRET_KEY in _PUBLIC_SECRET_KEYS:
+        raise RuntimeError(
+            "SECRET_KEY is unset or a public placeholder. Set it to a long random value, e.g. "
+            "python -c 'import secrets; print(secrets.token_urlsafe(32))'"
+        )
+    return config.SECRET_KEY
+
+def create_access_token(user: models.User) -> str:
+    """Issue a signed token carrying the claims needed to authorize requests"""
+    expires_at = int(time.time()) + config.ACCESS_TOKEN_EXPIRE_MINUTES * 60
+    claims = {
+        "sub": str(user.id),
+        "name": user.username,
+        "adm": bool(user.is_admin),
+        "plan": user.subscription_plan_id,
+        "exp": expires_at,
+    }
+    return jwt.encode(claims, signing_key(), algorithm=config.ALGORITHM)
+
+def decode_access_token(token: str) -> schemas.TokenData:
+    """Verify a token, reusing the cached result for tokens seen before"""
+    token_data = token_cache.get(token)
+    if token_data is None:
+        try:
+            claims = jwt.decode(token, signing_key(), algorithms=[config.ALGORITHM])
+            token_data = schemas.TokenData(
+                id=int(claims["sub"]),
+                username=claims["name"],
+                is_admin=claims["adm"],
+                subscription_plan_id=claims.get("plan"),
+                expires_at=claims["exp"],
+            )
+        except (JWTError, KeyError, ValueError):
+            raise HTTPException(status_code=401, detail="Invalid credentials")
+        token_cache.set(token, token_data)
+
+    if token_data.expires_at <= time.time():
+        token_cache.pop(token)
+        raise HTTPException(status_code=401, detail="Token has expired")
+    return token_data
+
+async def get_current_user(token: str = Depends(oauth2_scheme)) -> schemas.TokenData:
+    if not token:
+        raise HTTPException(status_code=401, detail="Authentication required")
+    return decode_access_token(token)
+
+async def get_current_admin(user: schemas.TokenData = Depends(get_current_user)) -> schemas.TokenData:
     if not user.is_admin:
         raise HTTPException(status_code=403, detail="Admin privileges required")
     return user
+
+async def require_ingest_key(key: Optional[str] = Depends(ingest_key_header)):
+    """Dependency for the usage reporting endpoints, which charge any user's quota"""
+    if not config.USAGE_INGEST_KEYS:
+        raise HTTPException(status_code=403, detail="Usage ingestion is not enabled")
+    # Compared against every key in constant time, so neither a key nor its position leaks
+    matched = False
+    for allowed in config.USAGE_INGEST_KEYS:
+        matched |= hmac.compare_digest((key or "").encode(), allowed.encode())
+    if not matched:
+        raise HTTPException(status_code=401, detail="Invalid ingestion key")
@@ -0,0 +1,208 @@
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+from sqlalchemy import bindparam, func, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from . import models, config, counters
+from .lru import LRUCache
+
+
+@dataclass(frozen=True)
+class Entitlement:
+    """Parsed view of a plan used by the access checks"""
+    plan_id: int
+    permissions: frozenset
+    usage_limit: int
+    rate_limit: Optional[float] = None
+    rate_limit_burst: Optional[int] = None
+    quota_period: Optional[str] = None
+
+    def window_start(self, now: Optional[datetime] = None) -> Optional[datetime]:
+        """Start (naive UTC) of the current quota window, or None for a lifetime quota"""
+        return counters.window_start(self.quota_period, now)
+
+
+class EntitlementCache:
+    """LRU of plan entitlements whose entries expire ``ttl`` seconds after loading.
+
+    Invalidations only reach the process that made the write, so the TTL bounds
+    how long other workers keep a changed plan. Each invalidation also bumps
+    ``generation``; a load that started before one is not stored, so it cannot
+    put back the entry the invalidation dropped.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 5.0):
+        self.ttl = ttl
+        self.generation = 0
+        self._entries = LRUCache(maxsize=maxsize)
+
+    def get(self, plan_id: int) -> Optional[Entitlement]:
+        entry = self._entries.get(plan_id)
+        if entry is None:
+            return None
+        entitlement, expires_at = entry
+        if expires_at <= time.monotonic():
+            self._entries.pop(plan_id)
+            return None
+        return entitlement
+
+    def set(self, entitlement: Entitlement, generation: int):
+        """Store an entitlement loaded while ``generation`` was current"""
+        if generation == self.generation:
+            self._entries.set(entitlement.plan_id, (entitlement, time.monotonic() + self.ttl))
+
+    def pop(self, plan_id: int):
+        self.generation += 1
+        self._entries.pop(plan_id)
+
+    def clear(self):
+        self.generation += 1
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+entitlement_cache = EntitlementCache(maxsize=config.ENTITLEMENT_CACHE_SIZE, ttl=config.ENTITLEMENT_CACHE_TTL)
+
+
+async def get_entitlement(db: AsyncSession, plan_id: Optional[int]) -> Optional[Entitlement]:
+    """Return the entitlement for a plan, loading it on a cache miss"""
+    if plan_id is None:
+        return None
+
+    entitlement = entitlement_cache.get(plan_id)
+    if entitlement is not None:
+        return entitlement
+
+    generation = entitlement_cache.generation
+    result = await db.execute(
+        select(
+            models.Plan.usage_limit,
+            models.Plan.rate_limit,
+            models.Plan.rate_limit_burst,
+            models.Plan.quota_period,
+            models.Permission.name,
+        )
+        .select_from(models.Plan)
+        .outerjoin(models.plan_permissions, models.plan_permissions.c.plan_id == models.Plan.id)
+        .outerjoin(models.Permission, models.Permission.id == models.plan_permissions.c.permission_id)
+        .where(models.Plan.id == plan_id)
+    )
+    rows = result.all()
+    if not rows:
+        return None
+
+    entitlement = Entitlement(
+        plan_id=plan_id,
+        permissions=frozenset(row.name for row in rows if row.name is not None),
+        usage_limit=rows[0].usage_limit,
+        rate_limit=rows[0].rate_limit,
+        rate_limit_burst=rows[0].rate_limit_burst,
+        quota_period=rows[0].quota_period,
+    )
+    entitlement_cache.set(entitlement, generation)
+    return entitlement
+
+
+async def get_entitlements(db: AsyncSession, plan_ids) -> dict:
+    """Entitlements for many plans by ID; the ones not cached are loaded with one IN query"""
+    entitlements = {}
+    missing = set()
+    for plan_id in plan_ids:
+        entitlement = entitlement_cache.get(plan_id)
+        if entitlement is not None:
+            entitlements[plan_id] = entitlement
+        else:
+            missing.add(plan_id)
+    if not missing:
+        return entitlements
+
+    generation = entitlement_cache.generation
+    result = await db.execute(
+        select(
+            models.Plan.id,
+            models.Plan.usage_limit,
+            models.Plan.rate_limit,
+            models.Plan.rate_limit_burst,
+            models.Plan.quota_period,
+            models.Permission.name,
+        )
+        .select_from(models.Plan)
+        .outerjoin(models.plan_permissions, models.plan_permissions.c.plan_id == models.Plan.id)
+        .outerjoin(models.Permission, models.Permission.id == models.plan_permissions.c.permission_id)
+        .where(models.Plan.id.in_(missing))
+    )
+    rows_by_plan = {}
+    for row in result:
+        rows_by_plan.setdefault(row.id, []).append(row)
+    for plan_id, rows in rows_by_plan.items():
+        entitlement = Entitlement(
+            plan_id=plan_id,
+            permissions=frozenset(row.name for row in rows if row.name is not None),
+            usage_limit=rows[0].usage_limit,
+            rate_limit=rows[0].rate_limit,
+            rate_limit_burst=rows[0].rate_limit_burst,
+            quota_period=rows[0].quota_period,
+        )
+        entitlement_cache.set(entitlement, generation)
+        entitlements[plan_id] = entitlement
+    return entitlements
+
+
+def invalidate_plan(plan_id: int):
+    """Drop a plan from the entitlement cache after it changes"""
+    entitlement_cache.pop(plan_id)
+
+
+def invalidate_all():
+    """Drop every cached entitlement, e.g. after a permission is renamed"""
+    entitlement_cache.clear()
+
+
+_versions = models.CollectionVersion.__table__
+_bump_versions_statement = sqlite_insert(_versions).on_conflict_do_update(
+    index_elements=[_versions.c.name],
+    set_={"version": _versions.c.version + 1},
+)
+_versions_query = (
+    select(_versions.c.name, _versions.c.version)
+    .where(_versions.c.name.in_(bindparam("b_names", expanding=True)))
+)
+
+
+def _version_of(collection: str):
+    return func.coalesce(select(_versions.c.version).where(_versions.c.name == collection).scalar_subquery(), 0)
+
+
+def _format_etag(versions) -> str:
+    return 'W/"%s"' % ".".join(str(version) for version in versions)
+
+
+class CollectionVersions:
+    """Version counters for the polled read endpoints, kept in the collection_versions table.
+
+    The crud write functions bump a collection inside the transaction that changes
+    it, so every worker reads the same versions (one primary-key lookup) and a
+    tag issued by one worker stays valid on the others until the data changes.
+    """
+
+    async def bump(self, db: AsyncSession, *collections: str):
+        await db.execute(_bump_versions_statement, [{"name": collection, "version": 1} for collection in collections])
+
+    async def get(self, db: AsyncSession, *collections: str) -> list[int]:
+        versions = dict((await db.execute(_versions_query, {"b_names": list(collections)})).all())
+        return [versions.get(collection, 0) for collection in collections]
+
+    async def etag(self, db: AsyncSession, *collections: str) -> str:
+        return _format_etag(await self.get(db, *collections))
+
+    async def etag_if(self, db: AsyncSession, condition, *collections: str) -> Optional[str]:
+        """``etag`` read in the same query as ``condition`` (e.g. an EXISTS); None when it is false"""
+        row = (await db.execute(select(condition, *(_version_of(collection) for collection in collections)))).one()
+        return _format_etag(row[1:]) if row[0] else None
+
+
+collection_versions = CollectionVersions()
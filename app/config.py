@@ -0,0 +1,82 @@
+import os
+
+# Maximum number of plans kept in the in-process entitlement cache
+ENTITLEMENT_CACHE_SIZE = int(os.getenv("ENTITLEMENT_CACHE_SIZE", "1024"))
+# Seconds a cached plan is trusted; bounds how long other workers serve a changed plan
+ENTITLEMENT_CACHE_TTL = float(os.getenv("ENTITLEMENT_CACHE_TTL", "5"))
+
+# Buffer usage increments in memory instead of charging them atomically in
+# the database. Only safe with a single worker process.
+USAGE_WRITE_BEHIND = os.getenv("USAGE_WRITE_BEHIND", "false").lower() in ("1", "true", "yes")
+
+# Usage is counted across this many rows per (user, API) so concurrent charges
+# for one heavy user land on different rows. SQLite serializes all writers anyway;
+# the spread pays off on engines with row-level locking.
+USAGE_COUNTER_SHARDS = int(os.getenv("USAGE_COUNTER_SHARDS", "4"))
+
+# Where quota usage is counted and enforced: "database" (usage_counters rows),
+# "shared_memory" (a memory-mapped file shared by the workers on one host) or
+# "redis" (any Redis-protocol server; QUOTA_REDIS_URL=inprocess starts a local stand-in)
+QUOTA_BACKEND = os.getenv("QUOTA_BACKEND", "database")
+QUOTA_SHM_PATH = os.getenv("QUOTA_SHM_PATH", "")  # "" = /dev/shm/cloud-service-quota
+QUOTA_SHM_SLOTS = int(os.getenv("QUOTA_SHM_SLOTS", "65536"))
+QUOTA_REDIS_URL = os.getenv("QUOTA_REDIS_URL", "redis://127.0.0.1:6379/0")
+QUOTA_REDIS_POOL_SIZE = int(os.getenv("QUOTA_REDIS_POOL_SIZE", "8"))
+
+# Seconds between checks for service registry changes made by other workers
+SERVICE_REGISTRY_REFRESH_INTERVAL = float(os.getenv("SERVICE_REGISTRY_REFRESH_INTERVAL", "1.0"))
+
+# Events applied per transaction by the bulk usage ingestion endpoint; also
+# bounds how much of a streamed body is held in memory at once
+USAGE_INGEST_CHUNK_SIZE = int(os.getenv("USAGE_INGEST_CHUNK_SIZE", "5000"))
+# Comma-separated keys accepted in X-Ingest-Key by POST /usage/{user_id} and /usage/bulk,
+# e.g. one per reporting proxy. With none set, usage can't be reported over HTTP.
+USAGE_INGEST_KEYS = [key.strip() for key in os.getenv("USAGE_INGEST_KEYS", "").split(",") if key.strip()]
+
+# Write-behind usage counters: flush pending increments every N seconds
+# or as soon as this many increments are buffered, whichever comes first
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "1.0"))
+USAGE_FLUSH_THRESHOLD = int(os.getenv("USAGE_FLUSH_THRESHOLD", "500"))
+
+# Signing settings for access tokens. SECRET_KEY has no default: the app refuses
+# to start without one, since anyone knowing the key can forge admin tokens.
+SECRET_KEY = os.getenv("SECRET_KEY", "")
+ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "30"))
+
+# Password hashing. Any passlib scheme (bcrypt, argon2, pbkdf2_sha256); ROUNDS is its
+# cost (bcrypt log2 rounds, argon2 time cost) and stored hashes below it are upgraded
+# on the next login. Hashes run on a pool of WORKERS threads, and logins beyond
+# MAX_PENDING in flight are rejected with 503 instead of queueing without bound.
+PASSWORD_HASH_SCHEME = os.getenv("PASSWORD_HASH_SCHEME", "bcrypt")
+PASSWORD_HASH_ROUNDS = int(os.getenv("PASSWORD_HASH_ROUNDS", "0")) or None  # None = passlib default
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "64"))
+
+# Number of verified tokens kept so hot tokens skip the signature check
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "4096"))
+
+# Per-user, per-API token bucket rate limiting (rates are set per plan)
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() in ("1", "true", "yes")
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+
+# Database connection. The async URL is derived from DATABASE_URL unless given.
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./test.db")
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL", DATABASE_URL.replace("sqlite://", "sqlite+aiosqlite://", 1))
+
+# "tuned" applies the pragmas and pool settings below; "default" keeps
+# SQLAlchemy/SQLite defaults (rollback journal, full sync)
+DB_PROFILE = os.getenv("DB_PROFILE", "tuned")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", "-65536"))  # negative = KiB
+SQLITE_BUSY_TIMEOUT = int(os.getenv("SQLITE_BUSY_TIMEOUT", "5000"))  # milliseconds
+
+# Per-request SQL profiling. Profile every request, or only those sending
+# the X-Profile-SQL: 1 header; the last N reports are kept for /debug/sql-profiles
+SQL_PROFILE = os.getenv("SQL_PROFILE", "false").lower() in ("1", "true", "yes")
+SQL_PROFILE_HISTORY = int(os.getenv("SQL_PROFILE_HISTORY", "100"))
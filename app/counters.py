@@ -0,0 +1,89 @@
+import random
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+from sqlalchemy import DateTime, bindparam, case, func, null, or_, select
+from . import models, config
+
+# Usage is counted in usage_counters rows keyed by (user, API, shard). Each
+# charge increments one randomly chosen shard, and a user's usage is the sum
+# of their rows whose window_start matches the current quota window. Rows
+# left over from an earlier window are ignored, then overwritten the next
+# time that shard is charged.
+
+
+def utc_now() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def window_start(quota_period: Optional[str], now: Optional[datetime] = None) -> Optional[datetime]:
+    """Start (naive UTC) of the current quota window, or None for a lifetime quota"""
+    if quota_period is None:
+        return None
+    now = now or utc_now()
+    if quota_period == "daily":
+        return now.replace(hour=0, minute=0, second=0, microsecond=0)
+    return now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def window_end(quota_period: Optional[str], start: Optional[datetime]) -> Optional[datetime]:
+    """Start of the window after ``start``, or None for a lifetime quota"""
+    if quota_period is None or start is None:
+        return None
+    if quota_period == "daily":
+        return start + timedelta(days=1)
+    if start.month == 12:
+        return start.replace(year=start.year + 1, month=1)
+    return start.replace(month=start.month + 1)
+
+
+def window_params(now: Optional[datetime] = None) -> dict:
+    """Bind values for ``plan_window()``"""
+    now = now or utc_now()
+    return {"b_daily_start": window_start("daily", now), "b_monthly_start": window_start("monthly", now)}
+
+
+def plan_window():
+    """Current window start for the plan joined into the enclosing query"""
+    return case(
+        (models.Plan.quota_period == "daily", bindparam("b_daily_start", type_=DateTime)),
+        (models.Plan.quota_period == "monthly", bindparam("b_monthly_start", type_=DateTime)),
+        else_=null(),
+    )
+
+
+def usage_sum(user_id, window):
+    """Scalar subquery totalling a user's shards for a window"""
+    # Aliased so the subquery never correlates with an INSERT/UPDATE on usage_counters
+    shards = models.UsageCounter.__table__.alias("shards")
+    return (
+        select(func.coalesce(func.sum(shards.c.count), 0))
+        .where(shards.c.user_id == user_id, shards.c.window_start.is_not_distinct_from(window))
+        .scalar_subquery()
+    )
+
+
+def usage_totals(min_usage):
+    """Subquery of (user_id, window_start, usage_count) for users at or above ``min_usage``.
+
+    Only reads rows of the current daily and monthly windows and lifetime rows,
+    through ix_usage_counters_window_user; join it on the plan window to keep
+    each user's own window.
+    """
+    shards = models.UsageCounter.__table__.alias("shards")
+    usage_count = func.sum(shards.c.count)
+    return (
+        select(shards.c.user_id, shards.c.window_start, usage_count.label("usage_count"))
+        .where(or_(
+            shards.c.window_start.in_([
+                bindparam("b_daily_start", type_=DateTime), bindparam("b_monthly_start", type_=DateTime),
+            ]),
+            shards.c.window_start.is_(None),
+        ))
+        .group_by(shards.c.window_start, shards.c.user_id)
+        .having(usage_count >= min_usage)
+        .subquery("usage_totals")
+    )
+
+
+def pick_shard() -> int:
+    return random.randrange(config.USAGE_COUNTER_SHARDS)
@@ -1,70 +1,500 @@
-from sqlalchemy.orm import Session
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+from sqlalchemy import select, insert, delete, update, func, exists, literal
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi import HTTPException
-from . import models, schemas
+from . import models, schemas, cache, services, auth, counters, quota
 
-def get_plan(db: Session, plan_id: int):
+async def get_plan(db: AsyncSession, plan_id: int):
     """Get a single plan by ID"""
-    return db.query(models.Plan).filter(models.Plan.id == plan_id).first()
+    return await db.get(models.Plan, plan_id)
 
-def get_plans(db: Session, skip: int = 0, limit: int = 100):
+async def get_plans(db: AsyncSession, skip: int = 0, limit: int = 100):
     """Get all plans with pagination"""
-    return db.query(models.Plan).offset(skip).limit(limit).all()
+    result = await db.execute(select(models.Plan).offset(skip).limit(limit))
+    return result.scalars().all()
 
 
-def create_plan(db: Session, plan: schemas.PlanCreate):
+async def create_plan(db: AsyncSession, plan: schemas.PlanCreate):
     """Create a new plan"""
+    names = parse_api_permissions(plan.api_permissions)
     db_plan = models.Plan(**plan.dict())
+    db_plan.api_permissions = ",".join(names)
     db.add(db_plan)
-    db.commit()
-    db.refresh(db_plan)
+    await db.flush()
+    await attach_plan_permissions(db, db_plan.id, names)
+    await cache.collection_versions.bump(db, "plans", "permissions")
+    await db.commit()
+    await db.refresh(db_plan)
     return db_plan
 
-def update_plan(db: Session, plan_id: int, plan: schemas.PlanUpdate):
+async def update_plan(db: AsyncSession, plan_id: int, plan: schemas.PlanUpdate):
     """Update an existing plan"""
-    db_plan = get_plan(db, plan_id)
+    db_plan = await get_plan(db, plan_id)
     if db_plan is None:
         raise HTTPException(status_code=404, detail="Plan not found")
 
     for key, value in plan.dict(exclude_unset=True).items():
         setattr(db_plan, key, value)
-    db.commit()
-    db.refresh(db_plan)
+    if plan.api_permissions is not None:
+        names = parse_api_permissions(plan.api_permissions)
+        db_plan.api_permissions = ",".join(names)
+        await db.execute(delete(models.plan_permissions).where(models.plan_permissions.c.plan_id == plan_id))
+        await attach_plan_permissions(db, plan_id, names)
+    # Attaching can create permissions that didn't exist yet
+    await cache.collection_versions.bump(db, "plans", "permissions")
+    await db.commit()
+    await db.refresh(db_plan)
+    cache.invalidate_plan(plan_id)
     return db_plan
 
-def delete_plan(db: Session, plan_id: int):
+async def delete_plan(db: AsyncSession, plan_id: int):
     """Delete a plan"""
-    db_plan = get_plan(db, plan_id)
+    db_plan = await get_plan(db, plan_id)
     if db_plan is None:
         raise HTTPException(status_code=404, detail="Plan not found")
-    db.delete(db_plan)
-    db.commit()
+    await db.execute(delete(models.plan_permissions).where(models.plan_permissions.c.plan_id == plan_id))
+    await db.delete(db_plan)
+    await cache.collection_versions.bump(db, "plans")
+    await db.commit()
+    cache.invalidate_plan(plan_id)
     return db_plan
 
-def create_permission(db: Session, permission: schemas.PermissionCreate):
+def parse_api_permissions(api_permissions: str | None) -> list[str]:
+    """Split a comma-separated permission string into unique names, keeping their order"""
+    names = []
+    for name in (api_permissions or "").split(','):
+        name = name.strip()
+        if name and name not in names:
+            names.append(name)
+    return names
+
+async def get_or_create_permissions(db: AsyncSession, names: list[str]) -> dict[str, int]:
+    """Map permission names to IDs, creating any that don't exist yet"""
+    if not names:
+        return {}
+    result = await db.execute(
+        select(models.Permission.name, models.Permission.id).where(models.Permission.name.in_(names))
+    )
+    ids = dict(result.all())
+    missing = [models.Permission(name=name) for name in names if name not in ids]
+    if missing:
+        db.add_all(missing)
+        await db.flush()
+        ids.update({permission.name: permission.id for permission in missing})
+    return ids
+
+async def attach_plan_permissions(db: AsyncSession, plan_id: int, names: list[str]):
+    """Grant permissions to a plan; names it already has are left alone"""
+    ids = await get_or_create_permissions(db, names)
+    result = await db.execute(
+        select(models.plan_permissions.c.permission_id).where(models.plan_permissions.c.plan_id == plan_id)
+    )
+    existing = set(result.scalars())
+    rows = [
+        {"plan_id": plan_id, "permission_id": ids[name]}
+        for name in names if ids[name] not in existing
+    ]
+    if rows:
+        await db.execute(insert(models.plan_permissions), rows)
+
+async def detach_plan_permissions(db: AsyncSession, plan_id: int, names: list[str]):
+    """Revoke permissions from a plan"""
+    if not names:
+        return
+    await db.execute(
+        delete(models.plan_permissions).where(
+            models.plan_permissions.c.plan_id == plan_id,
+            models.plan_permissions.c.permission_id.in_(
+                select(models.Permission.id).where(models.Permission.name.in_(names))
+            ),
+        )
+    )
+
+async def refresh_api_permissions(db: AsyncSession, plan_ids):
+    """Rebuild the api_permissions strings of plans from the association table"""
+    plan_ids = list(plan_ids)
+    if not plan_ids:
+        return
+    result = await db.execute(
+        select(models.plan_permissions.c.plan_id, models.Permission.name)
+        .join(models.Permission, models.Permission.id == models.plan_permissions.c.permission_id)
+        .where(models.plan_permissions.c.plan_id.in_(plan_ids))
+        .order_by(models.Permission.id)
+    )
+    names = {plan_id: [] for plan_id in plan_ids}
+    for plan_id, name in result.all():
+        names[plan_id].append(name)
+    await db.execute(
+        update(models.Plan).execution_options(synchronize_session=False),
+        [{"id": plan_id, "api_permissions": ",".join(plan_names)} for plan_id, plan_names in names.items()],
+    )
+
+async def update_plan_permissions(db: AsyncSession, plan_id: int, change: schemas.PlanPermissionsUpdate):
+    """Attach and detach permissions on a plan in one transaction"""
+    db_plan = await get_plan(db, plan_id)
+    if db_plan is None:
+        raise HTTPException(status_code=404, detail="Plan not found")
+
+    await attach_plan_permissions(db, plan_id, change.attach)
+    await detach_plan_permissions(db, plan_id, change.detach)
+    await refresh_api_permissions(db, [plan_id])
+    await cache.collection_versions.bump(db, "plans", "permissions")
+    await db.commit()
+    await db.refresh(db_plan)
+    cache.invalidate_plan(plan_id)
+    return db_plan
+
+async def bulk_upsert_plans(db: AsyncSession, batch: schemas.PlanBulk) -> list[schemas.BulkItemResult]:
+    """Create and update many plans in one transaction"""
+    results = []
+
+    # Creates: one multi-row INSERT, IDs returned in parameter order
+    names = [parse_api_permissions(plan.api_permissions) for plan in batch.create]
+    created_ids = []
+    if batch.create:
+        rows = [{**plan.dict(), "api_permissions": ",".join(plan_names)} for plan, plan_names in zip(batch.create, names)]
+        result = await db.execute(
+            insert(models.Plan).returning(models.Plan.id, sort_by_parameter_order=True), rows
+        )
+        created_ids = list(result.scalars())
+        for index, plan_id in enumerate(created_ids):
+            results.append(schemas.BulkItemResult(action="create", index=index, id=plan_id, ok=True))
+
+    # Updates: skip unknown IDs, then one executemany UPDATE by primary key
+    update_ids = [item.id for item in batch.update]
+    found = set((await db.execute(select(models.Plan.id).where(models.Plan.id.in_(update_ids)))).scalars()) if update_ids else set()
+    updates = []
+    replaced = {}
+    for index, item in enumerate(batch.update):
+        if item.id not in found:
+            results.append(schemas.BulkItemResult(action="update", index=index, id=item.id, ok=False, detail="Plan not found"))
+            continue
+        values = item.dict(exclude_unset=True)
+        if item.api_permissions is not None:
+            replaced[item.id] = parse_api_permissions(item.api_permissions)
+            values["api_permissions"] = ",".join(replaced[item.id])
+        updates.append(values)
+        results.append(schemas.BulkItemResult(action="update", index=index, id=item.id, ok=True))
+    if updates:
+        await db.execute(update(models.Plan).execution_options(synchronize_session=False), updates)
+    if replaced:
+        await db.execute(delete(models.plan_permissions).where(models.plan_permissions.c.plan_id.in_(list(replaced))))
+
+    # Association rows for every plan whose permissions were set
+    grants = list(zip(created_ids, names)) + list(replaced.items())
+    ids = await get_or_create_permissions(db, list(dict.fromkeys(name for _, plan_names in grants for name in plan_names)))
+    rows = [{"plan_id": plan_id, "permission_id": ids[name]} for plan_id, plan_names in grants for name in plan_names]
+    if rows:
+        await db.execute(insert(models.plan_permissions), rows)
+
+    await cache.collection_versions.bump(db, "plans", "permissions")
+    await db.commit()
+    for item in updates:
+        cache.invalidate_plan(item["id"])
+    return _in_request_order(results)
+
+async def bulk_upsert_permissions(db: AsyncSession, batch: schemas.PermissionBulk) -> list[schemas.BulkItemResult]:
+    """Create and update many permissions in one transaction"""
+    results = []
+    names = [permission.name for permission in batch.create] + [item.name for item in batch.update]
+    existing = dict((await db.execute(
+        select(models.Permission.name, models.Permission.id).where(models.Permission.name.in_(names))
+    )).all()) if names else {}
+
+    # Creates: reject names that exist or repeat within the batch
+    rows, row_indexes, seen = [], [], set()
+    for index, permission in enumerate(batch.create):
+        if permission.name in existing or permission.name in seen:
+            results.append(schemas.BulkItemResult(action="create", index=index, ok=False, detail="Permission already exists"))
+            continue
+        seen.add(permission.name)
+        rows.append(permission.dict())
+        row_indexes.append(index)
+    if rows:
+        result = await db.execute(
+            insert(models.Permission).returning(models.Permission.id, sort_by_parameter_order=True), rows
+        )
+        for index, permission_id in zip(row_indexes, result.scalars()):
+            results.append(schemas.BulkItemResult(action="create", index=index, id=permission_id, ok=True))
+
+    # Updates: the new name must not belong to another permission
+    update_ids = [item.id for item in batch.update]
+    found = set((await db.execute(
+        select(models.Permission.id).where(models.Permission.id.in_(update_ids))
+    )).scalars()) if update_ids else set()
+    updates = []
+    for index, item in enumerate(batch.update):
+        if item.id not in found:
+            detail = "Permission not found"
+        elif existing.get(item.name, item.id) != item.id or item.name in seen:
+            detail = "Permission already exists"
+        else:
+            seen.add(item.name)
+            updates.append(item.dict(exclude_unset=True))
+            results.append(schemas.BulkItemResult(action="update", index=index, id=item.id, ok=True))
+            continue
+        results.append(schemas.BulkItemResult(action="update", index=index, id=item.id, ok=False, detail=detail))
+    if updates:
+        await db.execute(update(models.Permission).execution_options(synchronize_session=False), updates)
+        result = await db.execute(
+            select(models.plan_permissions.c.plan_id).distinct()
+            .where(models.plan_permissions.c.permission_id.in_([item["id"] for item in updates]))
+        )
+        await refresh_api_permissions(db, result.scalars())
+
+    await cache.collection_versions.bump(db, "plans", "permissions")
+    await db.commit()
+    if updates:
+        cache.invalidate_all()
+    return _in_request_order(results)
+
+def _in_request_order(results: list[schemas.BulkItemResult]) -> list[schemas.BulkItemResult]:
+    return sorted(results, key=lambda result: (result.action != "create", result.index))
+
+async def move_plan_subscribers(db: AsyncSession, plan_id: int, target_plan_id: int) -> int:
+    """Move every user on one plan to another with a single UPDATE; returns the number moved"""
+    found = set((await db.execute(
+        select(models.Plan.id).where(models.Plan.id.in_([plan_id, target_plan_id]))
+    )).scalars())
+    if found != {plan_id, target_plan_id}:
+        raise HTTPException(status_code=404, detail="Plan not found")
+
+    result = await db.execute(
+        update(models.User)
+        .where(models.User.subscription_plan_id == plan_id)
+        .values(subscription_plan_id=target_plan_id)
+        .execution_options(synchronize_session=False)
+    )
+    await cache.collection_versions.bump(db, "subscriptions")
+    # The entitlement cache is keyed by plan and neither plan changed, so it is kept
+    await db.commit()
+    return result.rowcount
+
+async def _plans_with_permission(db: AsyncSession, permission_id: int) -> list[int]:
+    result = await db.execute(
+        select(models.plan_permissions.c.plan_id).where(models.plan_permissions.c.permission_id == permission_id)
+    )
+    return list(result.scalars())
+
+async def migrate_plan_permissions(db: AsyncSession):
+    """Populate the association table from the comma strings of plans that have no rows yet"""
+    migrated = select(models.plan_permissions.c.plan_id)
+    result = await db.execute(select(models.Plan).where(models.Plan.id.not_in(migrated)))
+    migrated_any = False
+    for plan in result.scalars():
+        await attach_plan_permissions(db, plan.id, parse_api_permissions(plan.api_permissions))
+        migrated_any = True
+    if migrated_any:
+        await cache.collection_versions.bump(db, "plans", "permissions")
+    await db.commit()
+
+async def get_services(db: AsyncSession):
+    result = await db.execute(select(models.Service).order_by(models.Service.name))
+    return result.scalars().all()
+
+async def get_service_by_name(db: AsyncSession, name: str):
+    result = await db.execute(select(models.Service).where(models.Service.name == name))
+    return result.scalars().first()
+
+async def create_service(db: AsyncSession, service: schemas.ServiceCreate):
+    """Register a service; plans can grant it through the permission of the same name"""
+    db_service = models.Service(**service.dict())
+    db.add(db_service)
+    await get_or_create_permissions(db, [service.name])
+    await cache.collection_versions.bump(db, "permissions", "services")
+    await db.commit()
+    services.registry.set(services.ServiceInfo.from_model(db_service))
+    return db_service
+
+async def update_service(db: AsyncSession, name: str, service: schemas.ServiceUpdate):
+    db_service = await get_service_by_name(db, name)
+    if db_service:
+        for key, value in service.dict(exclude_unset=True).items():
+            setattr(db_service, key, value)
+        await cache.collection_versions.bump(db, "services")
+        await db.commit()
+        services.registry.set(services.ServiceInfo.from_model(db_service))
+    return db_service
+
+DEFAULT_PLAN = {
+    "name": "Full Access Plan",
+    "description": "Access to all cloud services",
+    "api_permissions": "storage,compute,database,analytics,ai,messaging",
+    "usage_limit": 1000,
+}
+
+async def seed_defaults(db: AsyncSession):
+    """Create the admin user and the default plan when missing; safe to run on every start"""
+    if await get_user_by_username(db, "admin") is None:
+        await db.execute(
+            sqlite_insert(models.User)
+            .values(username="admin", hashed_password=await auth.password_hasher.hash("password"), is_admin=True)
+            .on_conflict_do_nothing(index_elements=["username"])
+        )
+    # Single INSERT ... SELECT ... WHERE NOT EXISTS so concurrent workers cannot both add it
+    plan_id = (await db.execute(
+        insert(models.Plan)
+        .from_select(
+            list(DEFAULT_PLAN),
+            select(*(literal(value).label(key) for key, value in DEFAULT_PLAN.items()))
+            .where(~exists().where(models.Plan.name == DEFAULT_PLAN["name"])),
+        )
+        .returning(models.Plan.id)
+    )).scalar()
+    if plan_id is not None:
+        await attach_plan_permissions(db, plan_id, parse_api_permissions(DEFAULT_PLAN["api_permissions"]))
+        await cache.collection_versions.bump(db, "plans", "permissions")
+    await db.commit()
+
+async def create_permission(db: AsyncSession, permission: schemas.PermissionCreate):
     db_permission = models.Permission(**permission.dict())
     db.add(db_permission)
-    db.commit()
-    db.refresh(db_permission)
+    await cache.collection_versions.bump(db, "permissions")
+    await db.commit()
+    await db.refresh(db_permission)
     return db_permission
 
-def get_permissions(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.Permission).offset(skip).limit(limit).all()
+async def get_permissions(db: AsyncSession, skip: int = 0, limit: int = 100):
+    result = await db.execute(select(models.Permission).offset(skip).limit(limit))
+    return result.scalars().all()
 
-def get_permission(db: Session, permission_id: int):
-    return db.query(models.Permission).filter(models.Permission.id == permission_id).first()
+async def get_permission(db: AsyncSession, permission_id: int):
+    return await db.get(models.Permission, permission_id)
 
-def update_permission(db: Session, permission_id: int, permission: schemas.PermissionUpdate):
-    db_permission = db.query(models.Permission).filter(models.Permission.id == permission_id).first()
+async def update_permission(db: AsyncSession, permission_id: int, permission: schemas.PermissionUpdate):
+    db_permission = await get_permission(db, permission_id)
     if db_permission:
         for key, value in permission.dict(exclude_unset=True).items():
             setattr(db_permission, key, value)
-        db.commit()
-        db.refresh(db_permission)
+        await db.flush()
+        # A rename changes what every plan granting this permission allows
+        await refresh_api_permissions(db, await _plans_with_permission(db, permission_id))
+        await cache.collection_versions.bump(db, "plans", "permissions")
+        await db.commit()
+        await db.refresh(db_permission)
+        cache.invalidate_all()
     return db_permission
 
-def delete_permission(db: Session, permission_id: int):
-    db_permission = db.query(models.Permission).filter(models.Permission.id == permission_id).first()
+async def delete_permission(db: AsyncSession, permission_id: int):
+    db_permission = await get_permission(db, permission_id)
     if db_permission:
-        db.delete(db_permission)
-        db.commit()
+        plan_ids = await _plans_with_permission(db, permission_id)
+        await db.execute(
+            delete(models.plan_permissions).where(models.plan_permissions.c.permission_id == permission_id)
+        )
+        await db.delete(db_permission)
+        await refresh_api_permissions(db, plan_ids)
+        await cache.collection_versions.bump(db, "plans", "permissions")
+        await db.commit()
+        cache.invalidate_all()
     return db_permission
+
+async def get_user(db: AsyncSession, user_id: int):
+    """Get a single user by ID"""
+    return await db.get(models.User, user_id)
+
+def user_exists(user_id: int):
+    """EXISTS clause on the user's primary key, for folding into another read"""
+    return exists().where(models.User.id == user_id)
+
+async def get_users(
+    db: AsyncSession,
+    cursor: Optional[int] = None,
+    limit: int = 100,
+    plan_id: Optional[int] = None,
+    is_admin: Optional[bool] = None,
+    min_usage: Optional[int] = None
+):
+    """List users ordered by ID, starting after ``cursor`` (keyset pagination).
+
+    Each user carries their usage in the current quota window. Returns the page
+    and the cursor for the next one, or None on the last page. When usage is
+    kept outside the database, ``min_usage`` is applied to each fetched page,
+    so a page may hold fewer than ``limit`` users.
+    """
+    params = counters.window_params()
+    in_database = quota.backend.counts_in_database
+    if min_usage is not None and min_usage > 0 and in_database:
+        # Start from the counter rows of the current windows that reach the
+        # threshold, so a sparse filter never walks the whole users table
+        totals = counters.usage_totals(min_usage)
+        usage = totals.c.usage_count
+        query = (
+            select(models.User, usage)
+            .join(totals, totals.c.user_id == models.User.id)
+            .outerjoin(models.Plan, models.Plan.id == models.User.subscription_plan_id)
+            .where(totals.c.window_start.is_not_distinct_from(counters.plan_window()))
+        )
+    else:
+        usage = counters.usage_sum(models.User.id, counters.plan_window())
+        query = (
+            select(models.User, usage.label("usage_count") if in_database else models.Plan.quota_period)
+            .outerjoin(models.Plan, models.Plan.id == models.User.subscription_plan_id)
+        )
+    query = query.order_by(models.User.id).limit(limit + 1)
+    if cursor is not None:
+        query = query.where(models.User.id > cursor)
+    if plan_id is not None:
+        query = query.where(models.User.subscription_plan_id == plan_id)
+    if is_admin is not None:
+        query = query.where(models.User.is_admin == is_admin)
+
+    rows = (await db.execute(query, params)).all()
+    next_cursor = rows[limit - 1][0].id if len(rows) > limit else None
+    rows = rows[:limit]
+    if in_database:
+        usage_counts = [usage_count for _, usage_count in rows]
+    else:
+        now = counters.utc_now()
+        usage_counts = await quota.backend.usage_many(
+            db, [(user.id, counters.window_start(quota_period, now)) for user, quota_period in rows]
+        )
+    users = [
+        schemas.User.model_validate(user).model_copy(update={"usage_count": usage_count})
+        for (user, _), usage_count in zip(rows, usage_counts)
+        if min_usage is None or usage_count >= min_usage
+    ]
+    return users, next_cursor
+
+async def set_user_subscription(db: AsyncSession, user: models.User, plan_id: int):
+    """Move a user onto a plan"""
+    user.subscription_plan_id = plan_id
+    await cache.collection_versions.bump(db, "subscriptions")
+    await db.commit()
+    return user
+
+async def get_user_by_username(db: AsyncSession, username: str):
+    """Get a single user by username"""
+    result = await db.execute(select(models.User).where(models.User.username == username))
+    return result.scalars().first()
+
+async def get_usage_per_api(db: AsyncSession, user_id: int) -> dict[str, int]:
+    """Total calls per API for a user, summed from the hourly rollups"""
+    result = await db.execute(
+        select(models.UsageRollupHour.api_name, func.sum(models.UsageRollupHour.count))
+        .where(models.UsageRollupHour.user_id == user_id)
+        .group_by(models.UsageRollupHour.api_name)
+    )
+    return dict(result.all())
+
+async def get_usage_buckets(db: AsyncSession, user_id: int, granularity: str, buckets: int):
+    """Per-API call counts for the last ``buckets`` minutes or hours"""
+    if granularity == "minute":
+        model, step = models.UsageRollupMinute, timedelta(minutes=1)
+        start = datetime.now(timezone.utc).replace(tzinfo=None, second=0, microsecond=0)
+    else:
+        model, step = models.UsageRollupHour, timedelta(hours=1)
+        start = datetime.now(timezone.utc).replace(tzinfo=None, minute=0, second=0, microsecond=0)
+    start -= step * (buckets - 1)
+
+    result = await db.execute(
+        select(model.bucket_start, model.api_name, model.count)
+        .where(model.user_id == user_id, model.bucket_start >= start)
+        .order_by(model.bucket_start, model.api_name)
+    )
+    return [
+        {"bucket_start": bucket_start, "api_name": api_name, "count": count}
+        for bucket_start, api_name, count in result.all()
+    ]
@@ -1,15 +1,72 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base
+import time
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import Session, declarative_base
+from . import config, metrics, profiler
+
+SQLALCHEMY_DATABASE_URL = config.DATABASE_URL
+ASYNC_SQLALCHEMY_DATABASE_URL = config.ASYNC_DATABASE_URL
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={config.SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous={config.SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA mmap_size={config.SQLITE_MMAP_SIZE}")
+    cursor.execute(f"PRAGMA cache_size={config.SQLITE_CACHE_SIZE}")
+    cursor.execute(f"PRAGMA busy_timeout={config.SQLITE_BUSY_TIMEOUT}")
+    cursor.close()
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start_time"].pop()
+    metrics.record_query(elapsed)
+    profiler.record_statement(statement, parameters, elapsed)
+
+def _instrument(db_engine):
+    """Count and time statements for the metrics endpoint and the SQL profiler"""
+    event.listen(db_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(db_engine, "after_cursor_execute", _after_cursor_execute)
+
+def _engine_options(url: str, profile: str) -> dict:
+    options = {}
+    if url.startswith("sqlite"):
+        options["connect_args"] = {"check_same_thread": False}
+    if profile == "tuned" and ":memory:" not in url:
+        options.update(
+            pool_size=config.DB_POOL_SIZE,
+            max_overflow=config.DB_MAX_OVERFLOW,
+            pool_timeout=config.DB_POOL_TIMEOUT,
+        )
+    return options
+
+def create_db_engine(url: str = SQLALCHEMY_DATABASE_URL, profile: str = config.DB_PROFILE):
+    """Build a synchronous engine using the given performance profile (used by offline benchmarks)"""
+    db_engine = create_engine(url, **_engine_options(url, profile))
+    if profile == "tuned" and url.startswith("sqlite"):
+        event.listen(db_engine, "connect", _set_sqlite_pragmas)
+    _instrument(db_engine)
+    return db_engine
+
+def create_async_db_engine(url: str = ASYNC_SQLALCHEMY_DATABASE_URL, profile: str = config.DB_PROFILE):
+    """Build an async engine using the given performance profile"""
+    db_engine = create_async_engine(url, **_engine_options(url, profile))
+    if profile == "tuned" and url.startswith("sqlite"):
+        event.listen(db_engine.sync_engine, "connect", _set_sqlite_pragmas)
+    _instrument(db_engine.sync_engine)
+    return db_engine
+
+# Lets the SQL profiler flag statements issued by relationship lazy loads
+event.listen(Session, "do_orm_execute", profiler.record_orm_execute)
+
+# Async engine used by the request handlers so queries don't block the event loop
+async_engine = create_async_db_engine()
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
-# Dependency for getting a database session
-def get_session_local():
-    db = SessionLocal()
-    try:
+# Dependency for getting an async database session
+async def get_async_session():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
@@ -0,0 +1,187 @@
+import codecs
+import json
+from collections import Counter
+from typing import AsyncIterator
+import orjson
+from pydantic import TypeAdapter, ValidationError
+from sqlalchemy.ext.asyncio import AsyncSession
+from . import config, schemas, utils, quota
+from .usage import usage_event_log
+
+# Largest single event accepted while scanning a stream, so a body without
+# separators cannot grow the buffer without bound
+MAX_EVENT_BYTES = 64 * 1024
+
+NDJSON_CONTENT_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+
+# What may follow a complete array element: a separator, the closing bracket or JSON whitespace
+_ELEMENT_DELIMITERS = frozenset(",] \t\r\n")
+
+_event_adapter = TypeAdapter(schemas.UsageEvent)
+_event_list_adapter = TypeAdapter(list[schemas.UsageEvent])
+
+
+class MalformedStream(ValueError):
+    """The body is not a JSON array or NDJSON stream of objects"""
+
+
+async def iter_ndjson(chunks: AsyncIterator[bytes]) -> AsyncIterator:
+    """Yield one decoded value per non-blank line; lines that are not JSON yield None"""
+    buffer = b""
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        if len(buffer) > MAX_EVENT_BYTES:
+            raise MalformedStream("NDJSON line too long")
+        for line in lines:
+            if line.strip():
+                yield _loads(line)
+    if buffer.strip():
+        yield _loads(buffer)
+
+
+def _loads(line: bytes):
+    try:
+        return orjson.loads(line)
+    except orjson.JSONDecodeError:
+        return None  # counted as an invalid event
+
+
+async def iter_json_array(chunks: AsyncIterator[bytes]) -> AsyncIterator:
+    """Yield the elements of a top-level JSON array as they arrive"""
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    state = "start"  # start -> first -> separator (-> value -> separator)* -> end
+    async for chunk in chunks:
+        buffer += text.decode(chunk)
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position].isspace():
+                position += 1
+            if position == len(buffer) or state == "end":
+                break
+            char = buffer[position]
+            if state == "start":
+                if char != "[":
+                    raise MalformedStream("Expected a JSON array")
+                state = "first"
+                position += 1
+            elif char == "]" and state in ("first", "separator"):
+                state = "end"
+                position += 1
+            elif state == "separator":
+                if char != ",":
+                    raise MalformedStream("Expected ',' or ']' between array elements")
+                state = "value"
+                position += 1
+            else:
+                try:
+                    value, end = decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    break  # incomplete element; wait for more of the body
+                if not isinstance(value, (dict, list)) and (end == len(buffer) or buffer[end] not in _ELEMENT_DELIMITERS):
+                    break  # a number may continue in the next chunk: "1." + "5", "2e" + "3"
+                position = end
+                state = "separator"
+                yield value
+        buffer = buffer[position:]
+        if len(buffer) > MAX_EVENT_BYTES:
+            raise MalformedStream("Array element too long or malformed")
+    buffer += text.decode(b"", final=True)
+    if state != "end":
+        raise MalformedStream("Unterminated or malformed JSON array")
+    if buffer.strip():
+        raise MalformedStream("Unexpected data after the JSON array")
+
+
+class UsageIngest:
+    """Applies a stream of usage events chunk by chunk and tallies the outcome per user"""
+
+    def __init__(self, db: AsyncSession, chunk_size: int = config.USAGE_INGEST_CHUNK_SIZE):
+        self.db = db
+        self.chunk_size = chunk_size
+        self.events = 0
+        self.invalid = 0
+        self._users = {}
+
+    async def run(self, events: AsyncIterator) -> dict:
+        chunk = []
+        async for event in events:
+            chunk.append(event)
+            if len(chunk) >= self.chunk_size:
+                await self._apply(chunk)
+                chunk = []
+        if chunk:
+            await self._apply(chunk)
+        return self.summary()
+
+    def summary(self) -> dict:
+        return {
+            "events": self.events,
+            "invalid": self.invalid,
+            "results": [
+                {"user_id": user_id, **{**result, "rejected": dict(result["rejected"])}}
+                for user_id, result in sorted(self._users.items())
+            ],
+        }
+
+    def _user(self, user_id: int) -> dict:
+        result = self._users.get(user_id)
+        if result is None:
+            result = self._users[user_id] = {
+                "accepted": 0, "rejected": Counter(), "current_usage": None, "usage_limit": None,
+            }
+        return result
+
+    def _validate(self, chunk: list) -> list:
+        """Validate the whole chunk in one pass, falling back to per-event checks to drop bad ones"""
+        try:
+            return _event_list_adapter.validate_python(chunk)
+        except ValidationError:
+            valid = []
+            for raw in chunk:
+                try:
+                    valid.append(_event_adapter.validate_python(raw))
+                except ValidationError:
+                    self.invalid += 1
+            return valid
+
+    async def _apply(self, chunk: list):
+        self.events += len(chunk)
+        events = self._validate(chunk)
+        entitlements = await utils.load_user_entitlements(self.db, {event.user_id for event in events})
+
+        # Fold the chunk into one amount per (user, API), then check each pair once
+        amounts = Counter()
+        for event in events:
+            amounts[(event.user_id, event.api_name)] += event.count
+
+        charges = []
+        for (user_id, api_name), amount in amounts.items():
+            entitlement = entitlements.get(user_id)
+            reason = None
+            if user_id not in entitlements:
+                reason = "User not found"
+            elif entitlement is None:
+                reason = "No active subscription"
+            elif api_name not in entitlement.permissions:
+                reason = "API not included in subscription plan"
+            if reason:
+                self._user(user_id)["rejected"][reason] += amount
+            else:
+                charges.append((user_id, entitlement, api_name, amount))
+
+        outcomes = await quota.backend.charge_many(self.db, charges)
+        for (user_id, entitlement, api_name, amount), (granted, usage_count) in zip(charges, outcomes):
+            result = self._user(user_id)
+            if usage_count is None:
+                result["rejected"]["Subscription changed"] += amount
+                continue
+            result["accepted"] += granted
+            if granted < amount:
+                result["rejected"]["Usage limit reached"] += amount - granted
+            if granted:
+                await usage_event_log.record(user_id, api_name, granted)
+            result["current_usage"] = usage_count
+            result["usage_limit"] = entitlement.usage_limit
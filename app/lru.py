@@ -0,0 +1,41 @@
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache:
+    """Thread-safe bounded mapping that evicts the least recently used entry"""
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            return self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def values(self):
+        with self._lock:
+            return list(self._data.values())
+
+    def __len__(self):
+        return len(self._data)
@@ -1,244 +1,369 @@
-from fastapi import FastAPI, Depends, HTTPException, Form
-from sqlalchemy.orm import Session
-from . import crud, models, schemas, database, auth, utils
-from .auth import get_current_user, get_current_admin
-
-def init_db():
-    database.Base.metadata.drop_all(bind=database.engine)
-    database.Base.metadata.create_all(bind=database.engine)
+import asyncio
+from typing import Literal, Optional
+from fastapi import FastAPI, Depends, HTTPException, Form, Query, Request
+from fastapi.responses import PlainTextResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from . import crud, schemas, database, auth, utils, cache, metrics, profiler, migrations, services, responses, quota, ingest
+from .auth import get_current_user, get_current_admin, require_ingest_key
+from .usage import usage_aggregator, usage_event_log
 
 app = FastAPI()
-
-init_db()
+app.add_middleware(metrics.MetricsMiddleware)
+app.add_middleware(profiler.SQLProfilerMiddleware)
 
 
 @app.on_event("startup")
 async def startup_event():
-    db = next(database.get_session_local())
-    try:
-        # Create admin user if not exists
-        print("Checking for admin user...")
-        admin = db.query(models.User).filter(models.User.username == "admin").first()
-        if not admin:
-            print("Creating admin user...")
-            admin = models.User(
-                username="admin",
-                hashed_password="password",  # In production, use proper password hashing
-                is_admin=True
-            )
-            db.add(admin)
-            db.commit()
-            print("Admin user created successfully")
-
-        # Create default plan if not exists
-        default_plan = db.query(models.Plan).filter(models.Plan.name == "Full Access Plan").first()
-        if not default_plan:
-            print("Creating default plan...")
-            default_plan = models.Plan(
-                name="Full Access Plan",
-                description="Access to all cloud services",
-                api_permissions="storage,compute,database,analytics,ai,messaging",
-                usage_limit=1000
-            )
-            db.add(default_plan)
-            db.commit()
-            print("Default plan created successfully")
-
-    except Exception as e:
-        print(f"Error during startup: {e}")
-    finally:
-        db.close()
-
-
-# Ensure database tables are created
-database.Base.metadata.create_all(bind=database.engine)
+    # Refuse to serve tokens signed with a missing or public key
+    auth.signing_key()
+    # DDL only runs when the stored schema version or fingerprint is out of date
+    upgraded = await migrations.upgrade_schema(database.async_engine)
+    async with database.AsyncSessionLocal() as db:
+        await crud.seed_defaults(db)
+        if upgraded:
+            # Move comma-separated plan permissions into the association table
+            await crud.migrate_plan_permissions(db)
+        await services.registry.load(db)
+    await quota.backend.start()
+
+    app.state.background_tasks = [
+        asyncio.create_task(usage_aggregator.run()),
+        asyncio.create_task(usage_event_log.run()),
+        asyncio.create_task(services.registry.run()),
+    ]
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Stop the periodic flushers and registry refresh, then write back any buffered usage
+    for task in app.state.background_tasks:
+        task.cancel()
+    await usage_aggregator.flush()
+    await usage_event_log.flush()
+    await quota.backend.close()
+
+
+# Prometheus metrics
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def read_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+# SQL profiles of recent requests sent with X-Profile-SQL: 1
+@app.get("/debug/sql-profiles")
+async def list_sql_profiles(current_user: schemas.TokenData = Depends(get_current_admin)):
+    return [profile.report() for profile in profiler.recent_profiles.values()]
+
+@app.get("/debug/sql-profiles/{profile_id}")
+async def read_sql_profile(profile_id: int, current_user: schemas.TokenData = Depends(get_current_admin)):
+    profile = profiler.recent_profiles.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return profile.report()
 
 
 # Subscription Plan Management
 
 # Read all plans
 @app.get("/plans/", response_model=list[schemas.Plan])
-def read_plans(
+async def read_plans(
+    request: Request,
     skip: int = 0,
     limit: int = 100,
-    db: Session = Depends(database.get_session_local)
+    db: AsyncSession = Depends(database.get_async_session)
 ):
     """Retrieve all subscription plans"""
-    plans = crud.get_plans(db, skip=skip, limit=limit)
-    return plans
+    etag = await cache.collection_versions.etag(db, "plans")
+    if responses.etag_matches(request, etag):
+        return responses.not_modified(etag)
+    plans = await crud.get_plans(db, skip=skip, limit=limit)
+    return responses.encode(responses.plan_list_adapter, plans, etag=etag)
 
 # Create plan
 @app.post("/plans/", response_model=schemas.Plan)
-def create_plan(
+async def create_plan(
     plan: schemas.PlanCreate,
-    db: Session = Depends(database.get_session_local),
-    current_user: models.User = Depends(get_current_admin)
+    db: AsyncSession = Depends(database.get_async_session),
+    current_user: schemas.TokenData = Depends(get_current_admin)
 ):
     """Create a new subscription plan"""
-    return crud.create_plan(db=db, plan=plan)
+    return await crud.create_plan(db=db, plan=plan)
 
 
 # Update plan
 @app.put("/plans/{plan_id}", response_model=schemas.Plan)
-def update_plan(
+async def update_plan(
     plan_id: int,
     plan: schemas.PlanUpdate,
-    db: Session = Depends(database.get_session_local),
-    current_user: models.User = Depends(get_current_admin)
+    db: AsyncSession = Depends(database.get_async_session),
+    current_user: schemas.TokenData = Depends(get_current_admin)
 ):
     """Update an existing subscription plan"""
-    return crud.update_plan(db=db, plan_id=plan_id, plan=plan)
+    return await crud.update_plan(db=db, plan_id=plan_id, plan=plan)
 
 
 # Delete plan
 @app.delete("/plans/{plan_id}", response_model=schemas.Plan)
-def delete_plan(
+async def delete_plan(
     plan_id: int,
-    db: Session = Depends(database.get_session_local),
-    current_user: models.User = Depends(get_current_admin)
+    db: AsyncSession = Depends(database.get_async_session),
+    current_user: schemas.TokenData = Depends(get_current_admin)
 ):
     """Delete a subscription plan"""
-    return crud.delete_plan(db=db, plan_id=plan_id)
+    return await crud.delete_plan(db=db, plan_id=plan_id)
+
+# Bulk create/update plans
+@app.post("/plans/bulk", response_model=schemas.BulkResult)
+async def bulk_upsert_plans(
+    batch: schemas.PlanBulk,
+    db: AsyncSession = Depends(database.get_async_session),
+    current_user: schemas.TokenData = Depends(get_current_admin)
+):
+    """Create and update many subscription plans in one transaction"""
+    return {"results": await crud.bulk_upsert_plans(db=db, batch=batch)}
+
+# Move all subscribers of a plan to another plan
+@app.post("/plans/{plan_id}/move-subscribers")
+async def move_plan_subscribers(
+    plan_id: int,
+    move: schemas.PlanMove,
+    db: AsyncSession = Depends(database.get_async_session),
+    current_user: schemas.TokenData = Depends(get_current_admin)
+):
+    """Move every user subscribed to a plan onto the target plan"""
+    moved = await crud.move_plan_subscribers(db=db, plan_id=plan_id, target_plan_id=move.target_plan_id)
+    return {"moved": moved}
+
+# Attach/detach permissions on a plan
+@app.patch("/plans/{plan_id}/permissions", response_model=schemas.Plan)
+async def update_plan_permissions(
+    plan_id: int,
+    change: schemas.PlanPermissionsUpdate,
+    db: AsyncSession = Depends(database.get_async_session),
+    current_user: schemas.TokenData = Depends(get_current_admin)
+):
+    """Grant or revoke several permissions on a plan at once"""
+    return await crud.update_plan_permissions(db=db, plan_id=plan_id, change=change)
 
 # Permission Management
 @app.post("/permissions/", response_model=schemas.Permission)
-def create_permission(
+async def create_permission(
     permission: schemas.PermissionCreate,
-    db: Session = Depends(database.get_session_local),
-    current_user: models.User = Depends(get_current_admin)
+    db: AsyncSession = Depends(database.get_async_session),
+    current_user: schemas.TokenData = Depends(get_current_admin)
 ):
-    return crud.create_permission(db, permission)
+    return await crud.create_permission(db, permission)
+
+@app.post("/permissions/bulk", response_model=schemas.BulkResult)
+async def bulk_upsert_permissions(
+    batch: schemas.PermissionBulk,
+    db: AsyncSession = Depends(database.get_async_session),
+    current_user: schemas.TokenData = Depends(get_current_admin)
+):
+    """Create and update many permissions in one transaction"""
+    return {"results": await crud.bulk_upsert_permissions(db=db, batch=batch)}
 
 @app.get("/permissions/", response_model=list[schemas.Permission])
-def read_permissions(
+async def read_permissions(
+    request: Request,
     skip: int = 0,
     limit: int = 100,
-    db: Session = Depends(database.get_session_local),
-    current_user: models.User = Depends(get_current_admin)
+    db: AsyncSession = Depends(database.get_async_session),
+    current_user: schemas.TokenData = Depends(get_current_admin)
 ):
-    return crud.get_permissions(db, skip=skip, limit=limit)
+    etag = await cache.collection_versions.etag(db, "permissions")
+    if responses.etag_matches(request, etag):
+        return responses.not_modified(etag)
+    permissions = await crud.get_permissions(db, skip=skip, limit=limit)
+    return responses.encode(responses.permission_list_adapter, permissions, etag=etag)
 
 @app.put("/permissions/{permission_id}", response_model=schemas.Permission)
-def update_permission(
+async def update_permission(
     permission_id: int,
     permission: schemas.PermissionUpdate,
-    db: Session = Depends(database.get_session_local),
-    current_user: models.User = Depends(get_current_admin)
+    db: AsyncSession = Depends(database.get_async_session),
+    current_user: schemas.TokenData = Depends(get_current_admin)
 ):
-    db_permission = crud.get_permission(db, permission_id=permission_id)
+    db_permission = await crud.get_permission(db, permission_id=permission_id)
     if not db_permission:
         raise HTTPException(status_code=404, detail="Permission not found")
-    return crud.update_permission(db=db, permission_id=permission_id, permission=permission)
+    return await crud.update_permission(db=db, permission_id=permission_id, permission=permission)
 
 @app.delete("/permissions/{permission_id}", response_model=schemas.Permission)
-def delete_permission(
+async def delete_permission(
     permission_id: int,
-    db: Session = Depends(database.get_session_local),
-    current_user: models.User = Depends(get_current_admin)
+    db: AsyncSession = Depends(database.get_async_session),
+    current_user: schemas.TokenData = Depends(get_current_admin)
 ):
-    db_permission = crud.get_permission(db, permission_id=permission_id)
+    db_permission = await crud.get_permission(db, permission_id=permission_id)
     if not db_permission:
         raise HTTPException(status_code=404, detail="Permission not found")
-    return crud.delete_permission(db=db, permission_id=permission_id)
+    return await crud.delete_permission(db=db, permission_id=permission_id)
 
-@app.post("/token")
+# Cloud service registry
+@app.get("/services/", response_model=list[schemas.Service])
+async def read_services(
+    db: AsyncSession = Depends(database.get_async_session),
+    current_user: schemas.TokenData = Depends(get_current_admin)
+):
+    return await crud.get_services(db)
+
+@app.post("/services/", response_model=schemas.Service)
+async def register_service(
+    service: schemas.ServiceCreate,
+    db: AsyncSession = Depends(database.get_async_session),
+    current_user: schemas.TokenData = Depends(get_current_admin)
+):
+    """Register a new service; it is served at /api/{name} immediately"""
+    if await crud.get_service_by_name(db, service.name):
+        raise HTTPException(status_code=400, detail="Service already registered")
+    return await crud.create_service(db, service)
+
+@app.put("/services/{service_name}", response_model=schemas.Service)
+async def update_service(
+    service_name: str,
+    service: schemas.ServiceUpdate,
+    db: AsyncSession = Depends(database.get_async_session),
+    current_user: schemas.TokenData = Depends(get_current_admin)
+):
+    """Change a service's response or enable/disable it"""
+    db_service = await crud.update_service(db, service_name, service)
+    if not db_service:
+        raise HTTPException(status_code=404, detail="Service not found")
+    return db_service
+
+@app.post("/token", response_model=schemas.Token)
 async def login_for_access_token(
     username: str = Form(...),
     password: str = Form(...),
-    db: Session = Depends(database.get_session_local)
+    db: AsyncSession = Depends(database.get_async_session)
 ):
-    # Print debug info
-    print(f"Login attempt - username: {username}, password: {password}")
-
-    user = db.query(models.User).filter(models.User.username == username).first()
-
-    # Print debug info
-    print(f"Found user: {user}")
-
-    if user and user.hashed_password == password:  # In production, use proper password hashing
-        return {"access_token": "admin_token", "token_type": "bearer"}
+    user = await crud.get_user_by_username(db, username)
+    verified, new_hash = await auth.password_hasher.verify_and_update(
+        password, user.hashed_password if user else None
+    )
+    if user and verified:
+        if new_hash:
+            # Plaintext, weaker or other-scheme hash: replace it now that we know the password
+            user.hashed_password = new_hash
+            await db.commit()
+        return {"access_token": auth.create_access_token(user), "token_type": "bearer"}
     raise HTTPException(status_code=401, detail="Invalid username or password")
 
-# Sample Cloud Services (Add 6 example APIs)
-@app.get("/api/storage")
-async def storage_service(
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(database.get_session_local)
+# Cloud services: one route for every registered service
+@app.get("/api/{service_name}")
+async def cloud_service(service: services.ServiceInfo = Depends(utils.require_registered_service)):
+    return responses.EncodedJSONResponse(service.payload)
+
+# User Directory
+@app.get("/users/", response_model=schemas.UserPage)
+async def list_users(
+    cursor: Optional[int] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    plan_id: Optional[int] = None,
+    is_admin: Optional[bool] = None,
+    min_usage: Optional[int] = None,
+    db: AsyncSession = Depends(database.get_async_session),
+    current_user: schemas.TokenData = Depends(get_current_admin)
 ):
-    utils.check_usage_limit(db, current_user, "storage")
-    return {"message": "Storage service accessed"}
+    """List users, optionally filtered by plan, admin flag and minimum usage.
 
-@app.get("/api/compute")
-async def compute_service(
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(database.get_session_local)
-):
-    utils.check_usage_limit(db, current_user, "compute")
-    return {"message": "Compute service accessed"}
+    Pass the returned ``next_cursor`` as ``cursor`` to fetch the following page.
+    """
+    users, next_cursor = await crud.get_users(
+        db, cursor=cursor, limit=limit, plan_id=plan_id, is_admin=is_admin, min_usage=min_usage
+    )
+    return {"items": users, "next_cursor": next_cursor}
 
 # User Subscription Management
 @app.post("/subscriptions/{plan_id}")
 async def subscribe_to_plan(
     plan_id: int,
-    db: Session = Depends(database.get_session_local),
-    current_user: models.User = Depends(get_current_user)
+    db: AsyncSession = Depends(database.get_async_session),
+    current_user: schemas.TokenData = Depends(get_current_user)
 ):
-    plan = crud.get_plan(db, plan_id)
+    plan = await crud.get_plan(db, plan_id)
     if not plan:
         raise HTTPException(status_code=404, detail="Plan not found")
 
-    current_user.subscription_plan_id = plan_id
-    db.commit()
-    return {"message": "Successfully subscribed to plan"}
+    user = await crud.get_user(db, current_user.id)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+
+    await crud.set_user_subscription(db, user, plan_id)
+    # Hand back a token carrying the new plan so service calls use it right away
+    return {
+        "message": "Successfully subscribed to plan",
+        "access_token": auth.create_access_token(user),
+        "token_type": "bearer"
+    }
 
 
 @app.get("/subscriptions/{user_id}", response_model=schemas.Plan)
 async def view_subscription_details(
+    request: Request,
     user_id: int,
-    db: Session = Depends(database.get_session_local),
-    current_user: models.User = Depends(get_current_user)
+    db: AsyncSession = Depends(database.get_async_session),
+    current_user: schemas.TokenData = Depends(get_current_user)
 ):
     """View current subscription details"""
-    user = db.query(models.User).filter(models.User.id == user_id).first()
+    # Covers both which plan the user is on and the contents of that plan; a 304 costs this one query
+    etag = await cache.collection_versions.etag_if(db, crud.user_exists(user_id), "subscriptions", "plans")
+    if etag is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    if responses.etag_matches(request, etag):
+        return responses.not_modified(etag)
+    user = await crud.get_user(db, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    return user.subscription_plan
+    plan = None
+    if user.subscription_plan_id is not None:
+        plan = await crud.get_plan(db, user.subscription_plan_id)
+    return responses.encode(responses.optional_plan_adapter, plan, etag=etag)
 
-@app.get("/subscriptions/{user_id}/usage")
+@app.get("/subscriptions/{user_id}/usage", response_class=responses.ORJSONResponse)
 async def view_usage_statistics(
     user_id: int,
-    db: Session = Depends(database.get_session_local),
-    current_user: models.User = Depends(get_current_user)
+    granularity: Literal["minute", "hour"] = "hour",
+    buckets: int = Query(24, ge=1, le=1000),
+    db: AsyncSession = Depends(database.get_async_session),
+    current_user: schemas.TokenData = Depends(get_current_user)
 ):
-    """View usage statistics"""
-    user = db.query(models.User).filter(models.User.id == user_id).first()
-    if not user:
+    """View usage statistics, with per-API totals and the most recent time buckets"""
+    resolved = await utils.resolve_user_entitlement(db, user_id)
+    if not resolved:
         raise HTTPException(status_code=404, detail="User not found")
+    entitlement = resolved.entitlement
+    usage_count = resolved.usage_count
     return {
-        "total_api_calls": user.usage_count,
-        "usage_limit": user.subscription_plan.usage_limit if user.subscription_plan else 0,
-        "remaining_calls": (user.subscription_plan.usage_limit - user.usage_count)
-            if user.subscription_plan else 0
+        "total_api_calls": usage_count,
+        "usage_limit": entitlement.usage_limit if entitlement else 0,
+        "remaining_calls": (entitlement.usage_limit - usage_count)
+            if entitlement else 0,
+        "quota_period": entitlement.quota_period if entitlement else None,
+        "window_start": resolved.window_start,
+        "calls_per_api": await crud.get_usage_per_api(db, user_id),
+        "granularity": granularity,
+        "buckets": await crud.get_usage_buckets(db, user_id, granularity, buckets)
     }
 
 @app.put("/subscriptions/{user_id}")
 async def modify_user_subscription(
     user_id: int,
     plan: schemas.SubscriptionUpdate,
-    db: Session = Depends(database.get_session_local),
-    current_user: models.User = Depends(get_current_admin)
+    db: AsyncSession = Depends(database.get_async_session),
+    current_user: schemas.TokenData = Depends(get_current_admin)
 ):
     """Admin endpoint to modify a user's subscription"""
-    user = db.query(models.User).filter(models.User.id == user_id).first()
+    user = await crud.get_user(db, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
-    new_plan = crud.get_plan(db, plan.plan_id)
+    new_plan = await crud.get_plan(db, plan.plan_id)
     if not new_plan:
         raise HTTPException(status_code=404, detail="Plan not found")
 
-    user.subscription_plan_id = plan.plan_id
-    db.commit()
+    await crud.set_user_subscription(db, user, plan.plan_id)
     return {"message": "Subscription updated successfully"}
 
 
@@ -246,110 +371,98 @@ async def modify_user_subscription(
 async def check_access_permission(
     user_id: int,
     api_name: str,
-    db: Session = Depends(database.get_session_local)
+    db: AsyncSession = Depends(database.get_async_session)
 ):
     """Check if user has permission to access specific API"""
-    user = db.query(models.User).filter(models.User.id == user_id).first()
-    if not user or not user.subscription_plan:
+    resolved = await utils.resolve_user_entitlement(db, user_id)
+    entitlement = resolved.entitlement if resolved else None
+    if entitlement is None:
         return {"has_access": False, "reason": "No active subscription"}
 
-    allowed_apis = user.subscription_plan.api_permissions.split(',')
-    has_access = api_name in allowed_apis and user.usage_count < user.subscription_plan.usage_limit
+    usage_count = resolved.usage_count
+    has_access = api_name in entitlement.permissions and usage_count < entitlement.usage_limit
 
     return {
         "has_access": has_access,
-        "current_usage": user.usage_count,
-        "limit": user.subscription_plan.usage_limit
+        "current_usage": usage_count,
+        "limit": entitlement.usage_limit
     }
 
-@app.post("/usage/{user_id}")
+@app.post("/access/batch", response_class=responses.ORJSONResponse)
+async def check_access_batch(
+    batch: schemas.AccessBatch,
+    db: AsyncSession = Depends(database.get_async_session)
+):
+    """Check many (user, API) pairs at once; decisions come back in request order"""
+    resolved = await utils.resolve_user_entitlements(db, (check.user_id for check in batch.checks))
+    results = []
+    for check in batch.checks:
+        user = resolved.get(check.user_id)
+        entitlement = user.entitlement if user else None
+        if entitlement is None:
+            results.append({
+                "user_id": check.user_id,
+                "api_name": check.api_name,
+                "has_access": False,
+                "reason": "No active subscription",
+            })
+            continue
+        results.append({
+            "user_id": check.user_id,
+            "api_name": check.api_name,
+            "has_access": check.api_name in entitlement.permissions and user.usage_count < entitlement.usage_limit,
+            "current_usage": user.usage_count,
+            "limit": entitlement.usage_limit,
+        })
+    return {"results": results}
+
+@app.post("/usage/bulk", response_class=responses.ORJSONResponse, dependencies=[Depends(require_ingest_key)])
+async def ingest_usage(
+    request: Request,
+    db: AsyncSession = Depends(database.get_async_session)
+):
+    """Apply a JSON array, or an NDJSON stream, of usage events; results are grouped per user.
+
+    The body is read and applied in chunks of ``USAGE_INGEST_CHUNK_SIZE`` events,
+    each in its own transaction.
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    parse = ingest.iter_ndjson if content_type in ingest.NDJSON_CONTENT_TYPES else ingest.iter_json_array
+    run = ingest.UsageIngest(db)
+    try:
+        return await run.run(parse(request.stream()))
+    except ingest.MalformedStream as e:
+        raise HTTPException(status_code=400, detail=f"{e}; the {run.events} events before it were applied")
+
+@app.post("/usage/{user_id}", dependencies=[Depends(require_ingest_key)])
 async def track_api_usage(
     user_id: int,
     usage: schemas.UsageCreate,
-    db: Session = Depends(database.get_session_local)
+    db: AsyncSession = Depends(database.get_async_session)
 ):
     """Track API usage for a user"""
-    user = db.query(models.User).filter(models.User.id == user_id).first()
-    if not user:
+    resolved = await utils.resolve_user_entitlement(db, user_id)
+    if not resolved:
         raise HTTPException(status_code=404, detail="User not found")
 
-    if not user.subscription_plan:
+    entitlement = resolved.entitlement
+    if entitlement is None:
         raise HTTPException(status_code=403, detail="No active subscription")
 
     # Check if API is allowed in user's plan
-    allowed_apis = user.subscription_plan.api_permissions.split(',')
-    if usage.api_name not in allowed_apis:
+    if usage.api_name not in entitlement.permissions:
         raise HTTPException(status_code=403, detail="API not included in subscription plan")
 
-    user.usage_count += 1
-    db.commit()
+    try:
+        usage_count = await utils.charge_usage(db, user_id, entitlement, usage.api_name)
+    except quota.PlanChanged:
+        raise HTTPException(status_code=403, detail="Subscription changed")
+    if usage_count is None:
+        raise HTTPException(status_code=403, detail="Usage limit reached")
 
     return {
-        "current_usage": user.usage_count,
+        "current_usage": usage_count,
         "api_name": usage.api_name,
-        "usage_limit": user.subscription_plan.usage_limit
+        "usage_limit": entitlement.usage_limit
     }
 
-@app.get("/api/database")
-async def database_service(
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(database.get_session_local)
-):
-    utils.check_usage_limit(db, current_user, "database")
-    return {"message": "Database service accessed"}
-
-@app.get("/api/analytics")
-async def analytics_service(
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(database.get_session_local)
-):
-    utils.check_usage_limit(db, current_user, "analytics")
-    return {"message": "Analytics service accessed"}
-
-@app.get("/api/ai")
-async def ai_service(
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(database.get_session_local)
-):
-    utils.check_usage_limit(db, current_user, "ai")
-    return {"message": "AI service accessed"}
-
-@app.get("/api/messaging")
-async def messaging_service(
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(database.get_session_local)
-):
-    utils.check_usage_limit(db, current_user, "messaging")
-    return {"message": "Messaging service accessed"}
-
-@app.get("/api/database")
-async def database_service(
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(database.get_session_local)
-):
-    utils.check_usage_limit(db, current_user, "database")
-    return {"message": "Database service accessed"}
-
-@app.get("/api/analytics")
-async def analytics_service(
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(database.get_session_local)
-):
-    utils.check_usage_limit(db, current_user, "analytics")
-    return {"message": "Analytics service accessed"}
-
-@app.get("/api/ai")
-async def ai_service(
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(database.get_session_local)
-):
-    utils.check_usage_limit(db, current_user, "ai")
-    return {"message": "AI service accessed"}
-
-@app.get("/api/messaging")
-async def messaging_service(
-    current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(database.get_session_local)
-):
-    utils.check_usage_limit(db, current_user, "messaging")
-    return {"message": "Messaging service accessed"}
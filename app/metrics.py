@@ -0,0 +1,160 @@
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Optional
+
+# Updates are plain dict/list operations. Handlers run on the event loop and the
+# GIL makes each update atomic enough for monitoring, so no locks are taken.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+
+    def inc(self, labels: tuple = (), amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labels, value in list(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._values = {}
+
+    def observe(self, value: float, labels: tuple = ()):
+        series = self._values.get(labels)
+        if series is None:
+            # per-bucket counts (last slot is +Inf), sum, count
+            series = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, count) in list(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                bucket_labels = _format_labels(self.labelnames, labels, 'le="' + le + '"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+http_requests = Counter(
+    "http_requests_total", "HTTP requests handled, by route and status", ("method", "route", "status")
+)
+http_request_duration = Histogram(
+    "http_request_duration_seconds", "HTTP request latency", ("method", "route")
+)
+db_statements = Counter(
+    "db_statements_total", "SQL statements executed, by the route that issued them", ("route",)
+)
+db_time = Counter(
+    "db_time_seconds_total", "Time spent executing SQL statements, by route", ("route",)
+)
+db_statements_per_request = Histogram(
+    "db_statements_per_request", "SQL statements executed per request", ("route",), buckets=STATEMENT_BUCKETS
+)
+quota_denials = Counter(
+    "quota_denials_total", "Service calls rejected by check_usage_limit, by reason", ("reason",)
+)
+
+REGISTRY = [http_requests, http_request_duration, db_statements, db_time, db_statements_per_request, quota_denials]
+
+
+class RequestStats:
+    """SQL activity attributed to the request being handled"""
+    __slots__ = ("statements", "db_time")
+
+    def __init__(self):
+        self.statements = 0
+        self.db_time = 0.0
+
+
+current_request: ContextVar[Optional[RequestStats]] = ContextVar("current_request", default=None)
+
+
+def record_query(elapsed: float):
+    """Called from the engine events for every executed statement"""
+    stats = current_request.get()
+    if stats is None:
+        # Statements from background work such as the usage flushers
+        db_statements.inc(("background",))
+        db_time.inc(("background",), elapsed)
+    else:
+        stats.statements += 1
+        stats.db_time += elapsed
+
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording per-route request counts, latency and SQL usage"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = current_request.set(stats)
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            current_request.reset(token)
+            route = scope.get("route")
+            route = route.path if route is not None else "unmatched"
+            method = scope["method"]
+            http_requests.inc((method, route, status))
+            http_request_duration.observe(elapsed, (method, route))
+            db_statements_per_request.observe(stats.statements, (route,))
+            if stats.statements:
+                db_statements.inc((route,), stats.statements)
+                db_time.inc((route,), stats.db_time)
@@ -0,0 +1,165 @@
+import hashlib
+from sqlalchemy import Column, DateTime, Float, Integer, String, MetaData, Table, inspect, select, delete, insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.schema import CreateIndex, CreateTable
+from sqlalchemy.ext.asyncio import AsyncEngine
+from . import models
+from .database import Base
+
+# Bookkeeping lives outside Base.metadata so it is not part of the fingerprint
+_bookkeeping = MetaData()
+schema_version = Table(
+    "schema_version",
+    _bookkeeping,
+    Column("version", Integer, nullable=False),
+    Column("fingerprint", String, nullable=False),
+)
+
+
+def _create_tables(conn):
+    """Create any table (and its indexes) that does not exist yet"""
+    Base.metadata.create_all(conn)
+
+
+def _add_missing_columns(conn, table: str, *columns: Column):
+    """ALTER TABLE ... ADD COLUMN for each (nullable) column the table lacks.
+
+    Steps spell their columns out rather than reading them off the models, so
+    they keep working after a later migration changes or drops the column.
+    """
+    existing = {column["name"] for column in inspect(conn).get_columns(table)}
+    for column in columns:
+        if column.name not in existing:
+            column_type = column.type.compile(dialect=conn.dialect)
+            conn.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {column.name} {column_type}")
+
+
+def _add_plan_rate_limit_columns(conn):
+    _add_missing_columns(conn, "plans", Column("rate_limit", Float), Column("rate_limit_burst", Integer))
+
+
+def _add_user_indexes(conn):
+    """Index the user lookup columns (the usage_count index of this era is dropped by step 6 anyway)"""
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_users_id ON users (id)")
+    conn.exec_driver_sql("CREATE UNIQUE INDEX IF NOT EXISTS ix_users_username ON users (username)")
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_users_subscription_plan_id ON users (subscription_plan_id)")
+
+
+def _create_services_table(conn):
+    """Move the six hard-coded services into the registry table"""
+    table = models.Service.__table__
+    table.create(conn, checkfirst=True)
+    if conn.execute(select(table.c.id).limit(1)).first() is None:
+        conn.execute(sqlite_insert(table).on_conflict_do_nothing(index_elements=["name"]), [
+            {"name": "storage", "message": "Storage service accessed", "enabled": True},
+            {"name": "compute", "message": "Compute service accessed", "enabled": True},
+            {"name": "database", "message": "Database service accessed", "enabled": True},
+            {"name": "analytics", "message": "Analytics service accessed", "enabled": True},
+            {"name": "ai", "message": "AI service accessed", "enabled": True},
+            {"name": "messaging", "message": "Messaging service accessed", "enabled": True},
+        ])
+
+
+def _add_quota_window_columns(conn):
+    _add_missing_columns(conn, "plans", Column("quota_period", String))
+    _add_missing_columns(conn, "users", Column("usage_window_start", DateTime))
+
+
+def _move_usage_to_counter_table(conn):
+    """Carry users.usage_count over to usage_counters, then drop the counter columns from users"""
+    models.UsageCounter.__table__.create(conn, checkfirst=True)
+    columns = {column["name"] for column in inspect(conn).get_columns("users")}
+    if "usage_count" in columns:
+        window = "usage_window_start" if "usage_window_start" in columns else "NULL"
+        # api_name '' holds calls made before usage was counted per API
+        conn.exec_driver_sql(
+            "INSERT OR IGNORE INTO usage_counters (user_id, api_name, shard, window_start, count) "
+            f"SELECT id, '', 0, {window}, usage_count FROM users WHERE usage_count > 0"
+        )
+        conn.exec_driver_sql("DROP INDEX IF EXISTS ix_users_usage_count")
+        conn.exec_driver_sql("ALTER TABLE users DROP COLUMN usage_count")
+    if "usage_window_start" in columns:
+        conn.exec_driver_sql("ALTER TABLE users DROP COLUMN usage_window_start")
+
+
+def _create_collection_versions_table(conn):
+    models.CollectionVersion.__table__.create(conn, checkfirst=True)
+
+
+def _add_usage_counter_window_index(conn):
+    """Index usage_counters by window, taking over from the dropped ix_users_usage_count"""
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_usage_counters_window_user ON usage_counters (window_start, user_id, count)"
+    )
+
+
+def _add_usage_event_count_column(conn):
+    """Let one usage_events row stand for several calls; existing rows are one call each"""
+    columns = {column["name"] for column in inspect(conn).get_columns("usage_events")}
+    if "count" not in columns:
+        conn.exec_driver_sql("ALTER TABLE usage_events ADD COLUMN count INTEGER DEFAULT '1' NOT NULL")
+
+
+# Ordered (version, step) pairs. Each step is idempotent, so a database created
+# before versioning existed can replay all of them safely.
+MIGRATIONS = [
+    (1, _create_tables),
+    (2, _add_plan_rate_limit_columns),
+    (3, _add_user_indexes),
+    (4, _create_services_table),
+    (5, _add_quota_window_columns),
+    (6, _move_usage_to_counter_table),
+    (7, _create_collection_versions_table),
+    (8, _add_usage_counter_window_index),
+    (9, _add_usage_event_count_column),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def schema_fingerprint(dialect) -> str:
+    """Hash of the DDL the models would produce, to catch model edits without a migration"""
+    digest = hashlib.sha256()
+    for table in Base.metadata.sorted_tables:
+        digest.update(str(CreateTable(table).compile(dialect=dialect)).encode())
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            digest.update(str(CreateIndex(index).compile(dialect=dialect)).encode())
+    return digest.hexdigest()
+
+
+def _upgrade(conn) -> bool:
+    fingerprint = schema_fingerprint(conn.dialect)
+    row = None
+    if inspect(conn).has_table(schema_version.name):
+        row = conn.execute(select(schema_version.c.version, schema_version.c.fingerprint)).first()
+    if row is not None and row.version == SCHEMA_VERSION and row.fingerprint == fingerprint:
+        return False
+
+    current = row.version if row is not None else 0
+    for version, step in MIGRATIONS:
+        if version > current:
+            print(f"Applying schema migration {version}: {step.__name__.lstrip('_')}")
+            step(conn)
+    if current == SCHEMA_VERSION:
+        # Models changed without a new migration; add whatever tables are missing
+        print("Schema fingerprint changed without a migration; creating missing tables")
+        _create_tables(conn)
+
+    _bookkeeping.create_all(conn)
+    conn.execute(delete(schema_version))
+    conn.execute(insert(schema_version), {"version": SCHEMA_VERSION, "fingerprint": fingerprint})
+    return True
+
+
+async def upgrade_schema(engine: AsyncEngine) -> bool:
+    """Bring the database up to the current schema; returns False when it already was.
+
+    pysqlite runs DDL outside a transaction unless one is open, so the steps would
+    each commit on their own. BEGIN IMMEDIATE takes the write lock before the
+    version is read: workers starting together queue here, and each one sees the
+    version the previous one stored.
+    """
+    async with engine.connect() as conn:
+        await conn.exec_driver_sql("BEGIN IMMEDIATE")
+        upgraded = await conn.run_sync(_upgrade)
+        await conn.commit()
+        return upgraded
@@ -1,8 +1,17 @@
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime
+from sqlalchemy import Column, Integer, String, Boolean, Float, ForeignKey, DateTime, Table, Index
 from sqlalchemy.orm import relationship
 from .database import Base
 
+# Which permissions (API names) each plan grants
+plan_permissions = Table(
+    "plan_permissions",
+    Base.metadata,
+    Column("plan_id", Integer, ForeignKey("plans.id", ondelete="CASCADE"), primary_key=True),
+    Column("permission_id", Integer, ForeignKey("permissions.id", ondelete="CASCADE"), primary_key=True),
+    Index("ix_plan_permissions_permission_id", "permission_id"),
+)
+
 class Plan(Base):
     __tablename__ = "plans"
     id = Column(Integer, primary_key=True, index=True)
@@ -10,6 +19,9 @@ class Plan(Base):
     description = Column(String)
     api_permissions = Column(String)
     usage_limit = Column(Integer)
+    rate_limit = Column(Float, nullable=True)  # requests per second per API, None = unlimited
+    rate_limit_burst = Column(Integer, nullable=True)
+    quota_period = Column(String, nullable=True)  # "daily", "monthly", None = lifetime quota
 
 class User(Base):
     __tablename__ = "users"
@@ -17,9 +29,8 @@ class User(Base):
     username = Column(String, unique=True, index=True)
     hashed_password = Column(String)
     is_admin = Column(Boolean, default=False)
-    subscription_plan_id = Column(Integer, ForeignKey('plans.id'))
+    subscription_plan_id = Column(Integer, ForeignKey('plans.id'), index=True)
     subscription_plan = relationship("Plan")
-    usage_count = Column(Integer, default=0)
 
 class Permission(Base):
     __tablename__ = "permissions"
@@ -27,3 +38,60 @@ class Permission(Base):
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, unique=True, index=True, nullable=False)
     description = Column(String, nullable=True)
+
+class Service(Base):
+    """Cloud service reachable at /api/{name}; its name doubles as the permission name"""
+    __tablename__ = "services"
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String, unique=True, index=True, nullable=False)
+    message = Column(String, nullable=False)
+    enabled = Column(Boolean, nullable=False, default=True)
+
+class UsageCounter(Base):
+    """One shard of a user's call count for an API within a quota window"""
+    __tablename__ = "usage_counters"
+
+    user_id = Column(Integer, ForeignKey('users.id', ondelete="CASCADE"), primary_key=True)
+    api_name = Column(String, primary_key=True)
+    shard = Column(Integer, primary_key=True)
+    window_start = Column(DateTime, nullable=True)  # None = lifetime quota
+    count = Column(Integer, nullable=False, default=0)
+
+    # Covers the min_usage filter of the user listing: totals per window and user
+    __table_args__ = (Index("ix_usage_counters_window_user", "window_start", "user_id", "count"),)
+
+class UsageEvent(Base):
+    """Append-only record of charged API calls; ``count`` calls reported together share one row"""
+    __tablename__ = "usage_events"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), index=True, nullable=False)
+    api_name = Column(String, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+    count = Column(Integer, nullable=False, server_default="1")
+
+class UsageRollupMinute(Base):
+    """Per-minute call counts per user and API, maintained as events are flushed"""
+    __tablename__ = "usage_rollups_minute"
+
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    bucket_start = Column(DateTime, primary_key=True)
+    api_name = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+class UsageRollupHour(Base):
+    """Per-hour call counts per user and API, maintained as events are flushed"""
+    __tablename__ = "usage_rollups_hour"
+
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    bucket_start = Column(DateTime, primary_key=True)
+    api_name = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+class CollectionVersion(Base):
+    """Change counter for a polled collection, bumped in the same transaction as the write"""
+    __tablename__ = "collection_versions"
+
+    name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
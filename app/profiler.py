@@ -0,0 +1,113 @@
+import itertools
+import time
+from collections import Counter
+from contextvars import ContextVar
+from typing import Optional
+from . import config
+from .lru import LRUCache
+
+PROFILE_REQUEST_HEADER = b"x-profile-sql"
+PROFILE_RESPONSE_HEADER = b"x-sql-profile"
+
+
+class SQLProfile:
+    """Every SQL statement one request executed, with timings"""
+
+    def __init__(self, profile_id: int, method: str, path: str):
+        self.id = profile_id
+        self.method = method
+        self.path = path
+        self.statements = []
+        self.pending_lazy_load = None
+        self.started_at = time.time()
+
+    def record(self, statement: str, parameters, elapsed: float):
+        self.statements.append({
+            "sql": statement,
+            "params": repr(parameters)[:200],
+            "duration_ms": round(elapsed * 1000, 3),
+            "lazy_load": self.pending_lazy_load,
+        })
+        self.pending_lazy_load = None
+
+    def report(self) -> dict:
+        by_sql = Counter(s["sql"] for s in self.statements)
+        duplicated = {sql for (sql, _), count in Counter((s["sql"], s["params"]) for s in self.statements).items() if count > 1}
+        # Same SQL with different parameters is the usual N+1 shape; identical
+        # parameters mean the exact same query ran more than once
+        repeated = [
+            {"sql": sql, "count": count, "identical_params": sql in duplicated}
+            for sql, count in by_sql.items() if count > 1
+        ]
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "total_statements": len(self.statements),
+            "db_time_ms": round(sum(s["duration_ms"] for s in self.statements), 3),
+            "repeated": repeated,
+            "lazy_loads": sum(1 for s in self.statements if s["lazy_load"]),
+            "statements": self.statements,
+        }
+
+    def summary(self) -> str:
+        report = self.report()
+        return (
+            f"id={report['id']}; statements={report['total_statements']}; db_ms={report['db_time_ms']}; "
+            f"repeated={len(report['repeated'])}; lazy_loads={report['lazy_loads']}"
+        )
+
+
+current_profile: ContextVar[Optional[SQLProfile]] = ContextVar("current_profile", default=None)
+recent_profiles = LRUCache(maxsize=config.SQL_PROFILE_HISTORY)
+_profile_ids = itertools.count(1)
+
+
+def record_statement(statement: str, parameters, elapsed: float):
+    """Called from the engine events; a no-op unless the request is being profiled"""
+    profile = current_profile.get()
+    if profile is not None:
+        profile.record(statement, parameters, elapsed)
+
+
+def record_orm_execute(orm_execute_state):
+    """Called from the session events to mark the next statement as a relationship lazy load"""
+    profile = current_profile.get()
+    if profile is None or not orm_execute_state.is_select:
+        return
+    if orm_execute_state.lazy_loaded_from is not None:
+        profile.pending_lazy_load = orm_execute_state.lazy_loaded_from.class_.__name__
+
+
+class SQLProfilerMiddleware:
+    """Profiles requests that send ``X-Profile-SQL: 1`` (or all of them with SQL_PROFILE=true).
+
+    The summary is returned in the ``X-SQL-Profile`` response header and the full
+    report is kept for the ``/debug/sql-profiles`` endpoints.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not (
+            config.SQL_PROFILE or dict(scope["headers"]).get(PROFILE_REQUEST_HEADER, b"") in (b"1", b"true")
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        profile = SQLProfile(next(_profile_ids), scope["method"], scope["path"])
+        token = current_profile.set(profile)
+
+        async def send_with_profile(message):
+            if message["type"] == "http.response.start":
+                recent_profiles.set(profile.id, profile)
+                headers = list(message.get("headers", []))
+                headers.append((PROFILE_RESPONSE_HEADER, profile.summary().encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_profile)
+        finally:
+            current_profile.reset(token)
@@ -0,0 +1,480 @@
+import calendar
+import mmap
+import os
+import struct
+import tempfile
+from datetime import datetime
+from threading import Lock
+from typing import Optional
+from fastapi import HTTPException
+from sqlalchemy import DateTime, bindparam, case, exists, false, func, literal, select, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from . import models, config, counters
+from .cache import Entitlement
+from .redis_protocol import RespClient, RespStandIn
+from .usage import usage_aggregator
+
+_on_plan = exists().where(
+    models.User.id == bindparam("b_user_id"),
+    models.User.subscription_plan_id == bindparam("b_plan_id"),
+)
+_on_plan_query = select(_on_plan)
+_users_plan_query = (
+    select(models.User.id, models.User.subscription_plan_id)
+    .where(models.User.id.in_(bindparam("b_user_ids", expanding=True)))
+)
+
+_usage_counters = models.UsageCounter.__table__
+_window_start = bindparam("b_window_start", type_=DateTime)
+_current_usage = counters.usage_sum(bindparam("b_user_id"), _window_start)
+_stored_usage_query = select(_current_usage).where(_on_plan)
+_usage_by_window_query = (
+    select(_usage_counters.c.user_id, _usage_counters.c.window_start, func.sum(_usage_counters.c.count))
+    .where(_usage_counters.c.user_id.in_(bindparam("b_user_ids", expanding=True)))
+    .group_by(_usage_counters.c.user_id, _usage_counters.c.window_start)
+)
+
+# Single guarded upsert: a shard row is only incremented while the user's
+# total for the window is under the limit. SQLite runs one writer at a time,
+# so concurrent requests (and workers) can never overshoot it. A shard still
+# holding an earlier window restarts at 1. RETURNING reports the new total.
+_charge_insert = sqlite_insert(_usage_counters).from_select(
+    ["user_id", "api_name", "shard", "window_start", "count"],
+    select(bindparam("b_user_id"), bindparam("b_api_name"), bindparam("b_shard"), _window_start, literal(1))
+    .where(_on_plan, _current_usage < bindparam("b_usage_limit")),
+)
+_charge_statement = _charge_insert.on_conflict_do_update(
+    index_elements=[_usage_counters.c.user_id, _usage_counters.c.api_name, _usage_counters.c.shard],
+    set_={
+        "count": case(
+            (_usage_counters.c.window_start.is_not_distinct_from(_charge_insert.excluded.window_start),
+             _usage_counters.c.count + 1),
+            else_=1,
+        ),
+        "window_start": _charge_insert.excluded.window_start,
+    },
+).returning(_current_usage)
+
+# Adds already-granted amounts; a shard still holding an earlier window restarts at the amount
+_add_usage_insert = sqlite_insert(_usage_counters)
+_add_usage_statement = _add_usage_insert.on_conflict_do_update(
+    index_elements=[_usage_counters.c.user_id, _usage_counters.c.api_name, _usage_counters.c.shard],
+    set_={
+        "count": case(
+            (_usage_counters.c.window_start.is_not_distinct_from(_add_usage_insert.excluded.window_start),
+             _usage_counters.c.count + _add_usage_insert.excluded.count),
+            else_=_add_usage_insert.excluded.count,
+        ),
+        "window_start": _add_usage_insert.excluded.window_start,
+    },
+)
+
+# Writes nothing, but takes SQLite's write lock so reads later in the transaction cannot go stale
+_write_lock_statement = update(_usage_counters).where(false()).values(count=_usage_counters.c.count)
+
+
+class PlanChanged(Exception):
+    """The user is no longer on the entitlement's plan, so nothing was charged"""
+
+
+async def current_plans(db: AsyncSession, user_ids) -> dict:
+    """Plan ID of each existing user among ``user_ids``, in one IN query"""
+    rows = await db.execute(_users_plan_query, {"b_user_ids": list(user_ids)})
+    return dict(rows.all())
+
+
+class QuotaBackend:
+    """Where per-user usage for a quota window is kept and charged.
+
+    ``charge`` must be atomic across every worker sharing the backend: a call
+    is only counted while the user is on the entitlement's plan and under its
+    limit. When ``counts_in_database`` is set, usage is read from the
+    usage_counters table inside the queries that load users.
+    """
+
+    counts_in_database = False
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def charge(self, db: AsyncSession, user_id: int, entitlement: Entitlement, api_name: str) -> Optional[int]:
+        """Count one call; returns the new usage, or None if the limit was reached.
+
+        Raises ``PlanChanged`` when the user is no longer on the entitlement's plan.
+        """
+        raise NotImplementedError
+
+    async def charge_many(self, db: AsyncSession, charges: list) -> list:
+        """Apply ``(user_id, entitlement, api_name, amount)`` charges in order.
+
+        Each charge is granted as much of its amount as fits under the user's
+        limit. Returns ``(granted, usage after the charge)`` for each, or
+        ``(0, None)`` when the user is no longer on the entitlement's plan.
+        """
+        raise NotImplementedError
+
+    async def usage(self, db: AsyncSession, user_id: int, window_start: Optional[datetime]) -> int:
+        return (await self.usage_many(db, [(user_id, window_start)]))[0]
+
+    async def usage_many(self, db: AsyncSession, keys: list) -> list:
+        """Usage for each ``(user_id, window_start)`` pair, in order"""
+        raise NotImplementedError
+
+    async def _on_plan(self, db: AsyncSession, user_id: int, plan_id: int) -> bool:
+        return (await db.execute(_on_plan_query, {"b_user_id": user_id, "b_plan_id": plan_id})).scalar()
+
+
+class DatabaseQuotaBackend(QuotaBackend):
+    """Sharded usage_counters rows charged with one guarded upsert (or buffered with write-behind)"""
+
+    counts_in_database = True
+
+    async def charge(self, db, user_id, entitlement, api_name):
+        window_start = entitlement.window_start()
+        params = {"b_user_id": user_id, "b_plan_id": entitlement.plan_id, "b_window_start": window_start}
+        if config.USAGE_WRITE_BEHIND:
+            stored_count = (await db.execute(_stored_usage_query, params)).scalar()
+            if stored_count is None:
+                raise PlanChanged()
+            usage_count = stored_count + usage_aggregator.pending(user_id, window_start)
+            if usage_count >= entitlement.usage_limit:
+                return None
+            await usage_aggregator.increment(user_id, api_name, window_start=window_start)
+            return usage_count + 1
+
+        usage_count = (await db.execute(_charge_statement, {
+            **params,
+            "b_api_name": api_name,
+            "b_shard": counters.pick_shard(),
+            "b_usage_limit": entitlement.usage_limit,
+        })).scalar()
+        # Only a refused charge pays for the read telling the plan guard apart from the limit
+        on_plan = usage_count is not None or await self._on_plan(db, user_id, entitlement.plan_id)
+        await db.commit()
+        if not on_plan:
+            raise PlanChanged()
+        return usage_count
+
+    async def charge_many(self, db, charges):
+        if not charges:
+            return []
+        if not config.USAGE_WRITE_BEHIND:
+            await db.execute(_write_lock_statement)
+        plans = await current_plans(db, {charge[0] for charge in charges})
+        now = counters.utc_now()
+        windows = [entitlement.window_start(now) for _, entitlement, _, _ in charges]
+        keys = list(dict.fromkeys(zip((charge[0] for charge in charges), windows)))
+        usage = dict(zip(keys, await self.usage_many(db, keys)))
+
+        results = []
+        rows = []
+        for (user_id, entitlement, api_name, amount), window_start in zip(charges, windows):
+            if plans.get(user_id) != entitlement.plan_id:
+                results.append((0, None))
+                continue
+            current = usage[(user_id, window_start)]
+            granted = max(0, min(amount, entitlement.usage_limit - current))
+            usage[(user_id, window_start)] = current + granted
+            results.append((granted, current + granted))
+            if granted:
+                rows.append({
+                    "user_id": user_id,
+                    "api_name": api_name,
+                    "shard": counters.pick_shard(),
+                    "window_start": window_start,
+                    "count": granted,
+                })
+
+        if config.USAGE_WRITE_BEHIND:
+            for row in rows:
+                await usage_aggregator.increment(row["user_id"], row["api_name"], row["count"], row["window_start"])
+            return results
+        if rows:
+            await db.execute(_add_usage_statement, rows)
+        await db.commit()
+        return results
+
+    async def usage_many(self, db, keys):
+        if not keys:
+            return []
+        # One grouped query for every user; each keeps only the total for its own window
+        rows = await db.execute(_usage_by_window_query, {"b_user_ids": list({user_id for user_id, _ in keys})})
+        stored = {(user_id, window_start): count for user_id, window_start, count in rows}
+        return [
+            stored.get((user_id, window_start), 0) + usage_aggregator.pending(user_id, window_start)
+            for user_id, window_start in keys
+        ]
+
+
+def _window_key(window_start: Optional[datetime]) -> int:
+    return calendar.timegm(window_start.timetuple()) if window_start is not None else -1
+
+
+class SharedMemoryQuotaBackend(QuotaBackend):
+    """Counters in a memory-mapped file shared by the worker processes on one host.
+
+    The file is an open-addressed table of ``(user_id, window, count)`` slots,
+    one per user; a slot still holding an earlier window restarts at zero, and
+    one whose window has ended can be taken over by a new user.
+    Every read-modify-write holds an exclusive ``flock`` on the file, so
+    charges from all workers are serialized. Counts survive worker restarts
+    but not a reboot when the file lives in /dev/shm.
+    """
+
+    _slot = struct.Struct("<qqq")
+
+    def __init__(self, path: str, slots: int):
+        import fcntl  # POSIX only, so only required when this backend is selected
+        self._fcntl = fcntl
+        self.path = path
+        self.slots = slots
+        self._lock = Lock()
+        self._fd = None
+        self._map = None
+
+    async def start(self):
+        if self._map is not None:
+            return
+        size = self.slots * self._slot.size
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+
+    async def close(self):
+        if self._map is not None:
+            self._map.close()
+            os.close(self._fd)
+            self._map = self._fd = None
+
+    def _probe(self, user_id: int, now: Optional[datetime] = None) -> tuple[Optional[int], bool]:
+        """``(offset, True)`` for the user's slot, else ``(offset, False)`` for the slot they would claim.
+
+        That is the first empty slot on the probe path, or an earlier one left
+        over from a window that has ended; its offset is None when the table is full.
+        """
+        # Every current window starts on or after the start of this month
+        stale_before = _window_key(counters.window_start("monthly", now))
+        index = (user_id * 2654435761) % self.slots
+        reusable = None
+        for _ in range(self.slots):
+            offset = index * self._slot.size
+            slot_user, slot_window, _ = self._slot.unpack_from(self._map, offset)
+            if slot_user == user_id:
+                return offset, True
+            if slot_user == 0:
+                return (offset if reusable is None else reusable), False
+            # A lifetime slot (window -1) is never stale
+            if reusable is None and 0 <= slot_window < stale_before:
+                reusable = offset
+            index = (index + 1) % self.slots
+        return reusable, False
+
+    def _claim(self, user_id: int, offset: Optional[int]):
+        if offset is None:
+            print(f"Quota table {self.path} is full; raise QUOTA_SHM_SLOTS")
+            raise HTTPException(status_code=503, detail="Quota table is full")
+        self._slot.pack_into(self._map, offset, user_id, _window_key(None), 0)
+
+    def _locked(self, operation):
+        with self._lock:
+            self._fcntl.flock(self._fd, self._fcntl.LOCK_EX)
+            try:
+                return operation()
+            finally:
+                self._fcntl.flock(self._fd, self._fcntl.LOCK_UN)
+
+    async def charge(self, db, user_id, entitlement, api_name):
+        if not await self._on_plan(db, user_id, entitlement.plan_id):
+            raise PlanChanged()
+        now = counters.utc_now()
+        window = _window_key(entitlement.window_start(now))
+
+        def increment():
+            offset, found = self._probe(user_id, now)
+            if not found:
+                self._claim(user_id, offset)
+            _, slot_window, count = self._slot.unpack_from(self._map, offset)
+            if slot_window != window:
+                count = 0
+            if count >= entitlement.usage_limit:
+                return None
+            self._slot.pack_into(self._map, offset, user_id, window, count + 1)
+            return count + 1
+
+        return self._locked(increment)
+
+    async def charge_many(self, db, charges):
+        if not charges:
+            return []
+        plans = await current_plans(db, {charge[0] for charge in charges})
+        now = counters.utc_now()
+
+        def increment_all():
+            # Claim every slot the batch needs before changing any count; if the
+            # table runs out, the claims are undone and nothing is charged
+            offsets = {}
+            claimed = []
+            for user_id, entitlement, _, _ in charges:
+                if plans.get(user_id) != entitlement.plan_id or user_id in offsets:
+                    continue
+                offset, found = self._probe(user_id, now)
+                if not found:
+                    if offset is None:
+                        for previous_offset, previous in reversed(claimed):
+                            self._map[previous_offset:previous_offset + self._slot.size] = previous
+                    else:
+                        claimed.append((offset, self._map[offset:offset + self._slot.size]))
+                    self._claim(user_id, offset)
+                offsets[user_id] = offset
+
+            results = []
+            for user_id, entitlement, _, amount in charges:
+                if plans.get(user_id) != entitlement.plan_id:
+                    results.append((0, None))
+                    continue
+                window = _window_key(entitlement.window_start(now))
+                offset = offsets[user_id]
+                _, slot_window, count = self._slot.unpack_from(self._map, offset)
+                if slot_window != window:
+                    count = 0
+                granted = max(0, min(amount, entitlement.usage_limit - count))
+                self._slot.pack_into(self._map, offset, user_id, window, count + granted)
+                results.append((granted, count + granted))
+            return results
+
+        return self._locked(increment_all)
+
+    async def usage_many(self, db, keys):
+        def read():
+            counts = []
+            for user_id, window_start in keys:
+                offset, found = self._probe(user_id)
+                count = 0
+                if found:
+                    _, slot_window, slot_count = self._slot.unpack_from(self._map, offset)
+                    if slot_window == _window_key(window_start):
+                        count = slot_count
+                counts.append(count)
+            return counts
+
+        return self._locked(read)
+
+
+class RedisQuotaBackend(QuotaBackend):
+    """Counters in a Redis-protocol key-value store shared by any number of hosts.
+
+    Each (user, window) is one key. A charge is ``INCR``; when the result is
+    over the limit it is taken back with ``DECR``, so only calls that got a
+    result within the limit are ever admitted. Keys expire a day after their
+    window ends. The URL ``inprocess`` starts a local stand-in server instead.
+    """
+
+    def __init__(self, url: str, pool_size: int, prefix: str = "quota"):
+        self.url = url
+        self.pool_size = pool_size
+        self.prefix = prefix
+        self._client = None
+        self._standin = None
+
+    async def start(self):
+        url = self.url
+        if url == "inprocess":
+            self._standin = RespStandIn()
+            await self._standin.start()
+            url = self._standin.url
+        # Built here rather than in __init__ so the pool belongs to the serving event loop
+        self._client = RespClient(url, pool_size=self.pool_size)
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+        if self._standin is not None:
+            await self._standin.close()
+            self._standin = None
+
+    def _key(self, user_id: int, window_start: Optional[datetime]) -> str:
+        return f"{self.prefix}:{user_id}:{_window_key(window_start)}"
+
+    async def charge(self, db, user_id, entitlement, api_name):
+        if not await self._on_plan(db, user_id, entitlement.plan_id):
+            raise PlanChanged()
+        window_start = entitlement.window_start()
+        key = self._key(user_id, window_start)
+        window_end = counters.window_end(entitlement.quota_period, window_start)
+        if window_end is None:
+            (count,) = await self._client.pipeline(("INCR", key))
+        else:
+            count, _ = await self._client.pipeline(
+                ("INCR", key),
+                ("EXPIREAT", key, _window_key(window_end) + 86400),
+            )
+        if count > entitlement.usage_limit:
+            await self._client.execute("DECR", key)
+            return None
+        return count
+
+    async def charge_many(self, db, charges):
+        if not charges:
+            return []
+        plans = await current_plans(db, {charge[0] for charge in charges})
+        now = counters.utc_now()
+        commands = []
+        incr_at = []  # position of each charge's INCRBY among the replies, None if not charged
+        for user_id, entitlement, _, amount in charges:
+            if plans.get(user_id) != entitlement.plan_id:
+                incr_at.append(None)
+                continue
+            window_start = entitlement.window_start(now)
+            key = self._key(user_id, window_start)
+            incr_at.append(len(commands))
+            commands.append(("INCRBY", key, amount))
+            window_end = counters.window_end(entitlement.quota_period, window_start)
+            if window_end is not None:
+                commands.append(("EXPIREAT", key, _window_key(window_end) + 86400))
+        replies = await self._client.pipeline(*commands) if commands else []
+
+        # Whatever went over the limit is taken back, as with a single charge
+        results = []
+        excess_by_key = {}
+        for (_, entitlement, _, amount), index in zip(charges, incr_at):
+            if index is None:
+                results.append((0, None))
+                continue
+            count = replies[index]
+            excess = min(amount, max(0, count - entitlement.usage_limit))
+            if excess:
+                key = commands[index][1]
+                excess_by_key[key] = excess_by_key.get(key, 0) + excess
+            results.append((amount - excess, min(count - excess, entitlement.usage_limit)))
+        if excess_by_key:
+            await self._client.pipeline(*(("DECRBY", key, excess) for key, excess in excess_by_key.items()))
+        return results
+
+    async def usage_many(self, db, keys):
+        if not keys:
+            return []
+        values = await self._client.execute("MGET", *(self._key(user_id, window) for user_id, window in keys))
+        # A concurrent charge that is about to be taken back can briefly push the count past the limit
+        return [int(value) if value is not None else 0 for value in values]
+
+
+def create_backend(name: str = config.QUOTA_BACKEND) -> QuotaBackend:
+    if name == "database":
+        return DatabaseQuotaBackend()
+    if name == "shared_memory":
+        path = config.QUOTA_SHM_PATH or os.path.join(
+            "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "cloud-service-quota"
+        )
+        return SharedMemoryQuotaBackend(path, config.QUOTA_SHM_SLOTS)
+    if name == "redis":
+        return RedisQuotaBackend(config.QUOTA_REDIS_URL, config.QUOTA_REDIS_POOL_SIZE)
+    raise ValueError(f"Unknown QUOTA_BACKEND {name!r}; expected database, shared_memory or redis")
+
+
+backend = create_backend()
@@ -0,0 +1,56 @@
+import math
+import time
+from threading import Lock
+from fastapi import HTTPException
+from . import config
+from .lru import LRUCache
+
+
+class TokenBucketLimiter:
+    """Per-key token buckets with bounded memory.
+
+    Each key holds ``[tokens, last_refill]``; refilling and taking a token is
+    O(1). Keys of inactive callers are evicted least recently used first.
+    """
+
+    def __init__(self, max_keys: int = 100000):
+        self._buckets = LRUCache(maxsize=max_keys)
+        self._lock = Lock()
+
+    def acquire(self, key, rate: float, burst: int) -> float:
+        """Take one token for ``key``; returns 0 if allowed, else seconds until one is available"""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = [float(burst), now]
+                self._buckets.set(key, bucket)
+            else:
+                bucket[0] = min(float(burst), bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0.0
+            return (1 - bucket[0]) / rate
+
+    def clear(self):
+        self._buckets.clear()
+
+
+rate_limiter = TokenBucketLimiter(max_keys=config.RATE_LIMIT_MAX_KEYS)
+
+
+def check_rate_limit(user_id: int, api_name: str, rate: float | None, burst: int | None):
+    """Reject the call with 429 if the user's bucket for this API is empty"""
+    if not config.RATE_LIMIT_ENABLED or not rate:
+        return
+    if burst is None:
+        burst = max(1, math.ceil(rate))
+    retry_after = rate_limiter.acquire((user_id, api_name), rate, burst)
+    if retry_after:
+        raise HTTPException(
+            status_code=429,
+            detail="Rate limit exceeded",
+            headers={"Retry-After": str(math.ceil(retry_after))},
+        )
@@ -0,0 +1,218 @@
+import asyncio
+import time
+from typing import Optional
+from urllib.parse import urlparse
+
+# Just enough of the Redis wire protocol (RESP2) for the quota backend: a small
+# pooled client, and an in-process stand-in server for development and tests.
+
+
+class RespError(Exception):
+    """Error reply sent by the server"""
+
+
+def _encode_command(args) -> bytes:
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode()
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+async def _read_reply(reader: asyncio.StreamReader):
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("Connection closed by server")
+    kind, body = line[:1], line[1:-2]
+    if kind == b"+":
+        return body.decode()
+    if kind == b"-":
+        return RespError(body.decode())
+    if kind == b":":
+        return int(body)
+    if kind == b"$":
+        length = int(body)
+        if length < 0:
+            return None
+        return (await reader.readexactly(length + 2))[:-2]
+    if kind == b"*":
+        length = int(body)
+        if length < 0:
+            return None
+        return [await _read_reply(reader) for _ in range(length)]
+    raise ConnectionError(f"Unexpected reply type {kind!r}")
+
+
+class RespClient:
+    """Pool of connections to a Redis-protocol server.
+
+    Each connection serves one caller at a time; ``pipeline`` sends several
+    commands in one round trip.
+    """
+
+    def __init__(self, url: str, pool_size: int = 8):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 6379
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self._password = parsed.password
+        self._idle = []
+        self._slots = asyncio.Semaphore(pool_size)
+
+    async def _connect(self):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        setup = []
+        if self._password:
+            setup.append(("AUTH", self._password))
+        if self.db:
+            setup.append(("SELECT", self.db))
+        for command in setup:
+            writer.write(_encode_command(command))
+            reply = await _read_reply(reader)
+            if isinstance(reply, RespError):
+                writer.close()
+                raise reply
+        return reader, writer
+
+    async def pipeline(self, *commands) -> list:
+        """Send ``commands`` together and return their replies in order"""
+        async with self._slots:
+            connection = self._idle.pop() if self._idle else await self._connect()
+            reader, writer = connection
+            try:
+                writer.write(b"".join(_encode_command(command) for command in commands))
+                await writer.drain()
+                replies = [await _read_reply(reader) for _ in commands]
+            except BaseException:
+                # The stream may hold a partial reply; never reuse it
+                writer.close()
+                raise
+            self._idle.append(connection)
+        for reply in replies:
+            if isinstance(reply, RespError):
+                raise reply
+        return replies
+
+    async def execute(self, *args):
+        return (await self.pipeline(args))[0]
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        for _, writer in idle:
+            writer.close()
+            await writer.wait_closed()
+
+
+class RespStandIn:
+    """In-process server for the commands the quota backend uses.
+
+    Supports PING, GET, MGET, SET, DEL, INCR, INCRBY, DECR, DECRBY, EXPIREAT
+    and FLUSHDB on a single keyspace, with expiry checked on access.
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._expires = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._connections = {}
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.sockets[0].getsockname()[:2]
+        return f"redis://{host}:{port}/0"
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0):
+        self._server = await asyncio.start_server(self._serve, host, port)
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            # Hang up on clients so each handler sees EOF and returns
+            handlers = list(self._connections)
+            for writer in self._connections.values():
+                writer.close()
+            await asyncio.gather(*handlers, return_exceptions=True)
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        handler = asyncio.current_task()
+        self._connections[handler] = writer
+        try:
+            while True:
+                try:
+                    command = await _read_reply(reader)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    break
+                writer.write(self._reply(self._dispatch(command)))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self._connections.pop(handler, None)
+            writer.close()
+
+    def _get(self, key: bytes) -> Optional[bytes]:
+        expires_at = self._expires.get(key)
+        if expires_at is not None and expires_at <= time.time():
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+        return self._data.get(key)
+
+    def _incr(self, key: bytes, amount: int):
+        value = self._get(key)
+        try:
+            value = int(value or 0) + amount
+        except ValueError:
+            return RespError("ERR value is not an integer or out of range")
+        self._data[key] = str(value).encode()
+        return value
+
+    def _dispatch(self, command):
+        if not isinstance(command, list) or not command:
+            return RespError("ERR protocol error")
+        name, args = command[0].upper(), command[1:]
+        if name == b"PING":
+            return "PONG"
+        if name == b"GET":
+            return self._get(args[0])
+        if name == b"MGET":
+            return [self._get(key) for key in args]
+        if name == b"SET":
+            self._data[args[0]] = args[1]
+            self._expires.pop(args[0], None)
+            return "OK"
+        if name == b"DEL":
+            removed = sum(self._get(key) is not None for key in args)
+            for key in args:
+                self._data.pop(key, None)
+                self._expires.pop(key, None)
+            return removed
+        if name in (b"INCR", b"DECR"):
+            return self._incr(args[0], 1 if name == b"INCR" else -1)
+        if name in (b"INCRBY", b"DECRBY"):
+            return self._incr(args[0], int(args[1]) if name == b"INCRBY" else -int(args[1]))
+        if name == b"EXPIREAT":
+            if self._get(args[0]) is None:
+                return 0
+            self._expires[args[0]] = int(args[1])
+            return 1
+        if name == b"FLUSHDB":
+            self._data.clear()
+            self._expires.clear()
+            return "OK"
+        return RespError(f"ERR unknown command '{name.decode()}'")
+
+    def _reply(self, value) -> bytes:
+        if isinstance(value, RespError):
+            return b"-%s\r\n" % str(value).encode()
+        if isinstance(value, str):
+            return b"+%s\r\n" % value.encode()
+        if isinstance(value, int):
+            return b":%d\r\n" % value
+        if value is None:
+            return b"$-1\r\n"
+        if isinstance(value, list):
+            return b"*%d\r\n" % len(value) + b"".join(self._reply(item) for item in value)
+        return b"$%d\r\n%s\r\n" % (len(value), value)
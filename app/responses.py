@@ -0,0 +1,50 @@
+from typing import Any, Optional
+import orjson
+from fastapi import Request
+from fastapi.responses import JSONResponse, Response
+from pydantic import TypeAdapter
+from . import schemas
+
+# Built once; validating through these skips FastAPI's per-request response_model
+# handling and lets pydantic-core write the JSON bytes directly
+plan_list_adapter = TypeAdapter(list[schemas.Plan])
+permission_list_adapter = TypeAdapter(list[schemas.Permission])
+optional_plan_adapter = TypeAdapter(Optional[schemas.Plan])
+
+
+class ORJSONResponse(JSONResponse):
+    """JSONResponse encoded with orjson, for handlers that return plain dicts"""
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
+
+
+class EncodedJSONResponse(Response):
+    """Response whose body is already JSON bytes"""
+    media_type = "application/json"
+
+
+def encode(adapter: TypeAdapter, value, etag: Optional[str] = None) -> EncodedJSONResponse:
+    """Validate ORM objects through a prebuilt adapter and return the JSON response"""
+    headers = {"ETag": etag} if etag else None
+    return EncodedJSONResponse(adapter.dump_json(adapter.validate_python(value, from_attributes=True)), headers=headers)
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Whether If-None-Match names ``etag``, using the weak comparison RFC 9110 requires"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == opaque for tag in header.split(","))
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag})
+
+
+def encode_static(content: Any) -> bytes:
+    """Pre-encode a constant payload once so handlers can return the bytes as is"""
+    return orjson.dumps(content)
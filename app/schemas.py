@@ -1,11 +1,16 @@
-from pydantic import BaseModel
-from typing import Optional
+from pydantic import BaseModel, Field
+from typing import Literal, Optional
+
+QuotaPeriod = Literal["daily", "monthly"]
 
 class PlanBase(BaseModel):
     name: str
     description: str
     api_permissions: str
     usage_limit: int
+    rate_limit: Optional[float] = Field(None, gt=0)  # requests per second per API
+    rate_limit_burst: Optional[int] = Field(None, ge=1)
+    quota_period: Optional[QuotaPeriod] = None
 
 class PlanCreate(PlanBase):
     pass
@@ -16,6 +21,9 @@ class PlanUpdate(BaseModel):
     description: Optional[str] = None
     api_permissions: Optional[str] = None
     usage_limit: Optional[int] = None
+    rate_limit: Optional[float] = Field(None, gt=0)
+    rate_limit_burst: Optional[int] = Field(None, ge=1)
+    quota_period: Optional[QuotaPeriod] = None
 
 class Plan(PlanBase):
     id: int
@@ -23,6 +31,20 @@ class Plan(PlanBase):
     class Config:
         from_attributes = True
 
+class PlanPermissionsUpdate(BaseModel):
+    attach: list[str] = []
+    detach: list[str] = []
+
+class PlanBulkUpdateItem(PlanUpdate):
+    id: int
+
+class PlanBulk(BaseModel):
+    create: list[PlanCreate] = []
+    update: list[PlanBulkUpdateItem] = []
+
+class PlanMove(BaseModel):
+    target_plan_id: int
+
 class PermissionBase(BaseModel):
     name: str
     description: str | None = None
@@ -33,14 +55,89 @@ class PermissionCreate(PermissionBase):
 class PermissionUpdate(PermissionBase):
     pass
 
+class PermissionBulkUpdateItem(PermissionUpdate):
+    id: int
+
+class PermissionBulk(BaseModel):
+    create: list[PermissionCreate] = []
+    update: list[PermissionBulkUpdateItem] = []
+
 class Permission(PermissionBase):
     id: int
 
     class Config:
         from_attributes = True
 
+class ServiceBase(BaseModel):
+    name: str
+    message: str
+    enabled: bool = True
+
+class ServiceCreate(ServiceBase):
+    pass
+
+class ServiceUpdate(BaseModel):
+    message: str | None = None
+    enabled: bool | None = None
+
+class Service(ServiceBase):
+    id: int
+
+    class Config:
+        from_attributes = True
+
+class User(BaseModel):
+    id: int
+    username: str
+    is_admin: bool
+    subscription_plan_id: Optional[int] = None
+    usage_count: int = 0  # calls in the current quota window
+
+    class Config:
+        from_attributes = True
+
+class UserPage(BaseModel):
+    items: list[User]
+    next_cursor: Optional[int] = None
+
 class SubscriptionUpdate(BaseModel):
     plan_id: int
 
 class UsageCreate(BaseModel):
     api_name: str
+
+class UsageEvent(BaseModel):
+    """One reported call (or ``count`` calls) to an API by a user"""
+    user_id: int = Field(ge=-2**63, le=2**63 - 1)  # SQLite INTEGER range
+    api_name: str
+    count: int = Field(1, ge=1, le=1_000_000)
+
+class AccessCheck(BaseModel):
+    user_id: int
+    api_name: str
+
+class AccessBatch(BaseModel):
+    checks: list[AccessCheck] = Field(max_length=10000)
+
+class Token(BaseModel):
+    access_token: str
+    token_type: str
+
+class TokenData(BaseModel):
+    """Claims carried by a verified access token"""
+    id: int
+    username: str
+    is_admin: bool
+    subscription_plan_id: Optional[int] = None
+    expires_at: int
+
+class BulkItemResult(BaseModel):
+    """Outcome of one item in a bulk request; ``index`` is its position in its list"""
+    action: str
+    index: int
+    id: Optional[int] = None
+    ok: bool
+    detail: Optional[str] = None
+
+class BulkResult(BaseModel):
+    results: list[BulkItemResult]
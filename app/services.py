@@ -0,0 +1,72 @@
+import asyncio
+from dataclasses import dataclass
+from typing import Optional
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from . import models, responses, cache, config, database
+
+
+@dataclass(frozen=True)
+class ServiceInfo:
+    """Registry entry for one cloud service"""
+    name: str
+    message: str
+    enabled: bool
+    payload: bytes  # the response body, encoded once
+
+    @classmethod
+    def from_model(cls, service: models.Service) -> "ServiceInfo":
+        return cls(
+            name=service.name,
+            message=service.message,
+            enabled=service.enabled,
+            payload=responses.encode_static({"message": service.message}),
+        )
+
+
+class ServiceRegistry:
+    """In-memory copy of the services table so a lookup is a single dict access.
+
+    Loaded at startup and kept current by the crud writes on this worker. Writes
+    also bump the "services" collection version; ``run`` polls it so the other
+    workers reload within ``refresh_interval`` seconds.
+    """
+
+    def __init__(self, refresh_interval: float = 1.0):
+        self.refresh_interval = refresh_interval
+        self.version = None
+        self._services = {}
+
+    def get(self, name: str) -> Optional[ServiceInfo]:
+        return self._services.get(name)
+
+    def set(self, service: ServiceInfo):
+        self._services[service.name] = service
+
+    def __len__(self):
+        return len(self._services)
+
+    async def load(self, db: AsyncSession):
+        (self.version,) = await cache.collection_versions.get(db, "services")
+        result = await db.execute(select(models.Service))
+        # Swap the whole mapping so readers never see a half-built registry
+        self._services = {service.name: ServiceInfo.from_model(service) for service in result.scalars()}
+
+    async def refresh(self):
+        """Reload if the services table changed since the last load"""
+        async with database.AsyncSessionLocal() as db:
+            (version,) = await cache.collection_versions.get(db, "services")
+            if version != self.version:
+                await self.load(db)
+
+    async def run(self):
+        """Background loop that picks up service changes made by other workers"""
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                print(f"Error refreshing {type(self).__name__}: {e}")
+
+
+registry = ServiceRegistry(refresh_interval=config.SERVICE_REGISTRY_REFRESH_INTERVAL)
@@ -0,0 +1,179 @@
+import asyncio
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from threading import Lock
+from typing import Optional
+from sqlalchemy import case, func, insert, true
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from . import models, database, config, counters
+
+
+class BatchWriter:
+    """Base for buffers that are written back periodically by a background task"""
+
+    def __init__(self, flush_interval: float = 1.0, flush_threshold: int = 500):
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+
+    async def flush(self):
+        raise NotImplementedError
+
+    async def run(self):
+        """Background loop that flushes on the configured interval"""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Error flushing {type(self).__name__}: {e}")
+
+
+class UsageAggregator(BatchWriter):
+    """Buffers per-user usage increments and writes them back in batches.
+
+    Increments are keyed by (user_id, api_name, quota window start) so a flush
+    can reset counter shards that belong to an earlier window, like the
+    synchronous charge does. Per-user totals are tracked alongside for ``pending``.
+    """
+
+    def __init__(self, flush_interval: float = 1.0, flush_threshold: int = 500):
+        super().__init__(flush_interval, flush_threshold)
+        self._pending = defaultdict(int)
+        self._pending_totals = defaultdict(int)
+        self._flushing = {}
+        self._buffered = 0
+        self._lock = Lock()
+
+    async def increment(self, user_id: int, api_name: str, amount: int = 1, window_start: Optional[datetime] = None):
+        """Record usage for a user; flushes inline once the threshold is hit"""
+        with self._lock:
+            self._pending[(user_id, api_name, window_start)] += amount
+            self._pending_totals[(user_id, window_start)] += amount
+            self._buffered += amount
+            should_flush = self._buffered >= self.flush_threshold
+        if should_flush:
+            await self.flush()
+
+    def pending(self, user_id: int, window_start: Optional[datetime] = None) -> int:
+        """Usage recorded for a user in a window that is not yet visible in the database"""
+        key = (user_id, window_start)
+        with self._lock:
+            return self._pending_totals.get(key, 0) + self._flushing.get(key, 0)
+
+    async def flush(self):
+        """Write all buffered increments in a single batched upsert"""
+        with self._lock:
+            if not self._pending:
+                return
+            batch = dict(self._pending)
+            self._pending.clear()
+            self._pending_totals.clear()
+            self._buffered = 0
+            for (user_id, _, window), delta in batch.items():
+                self._flushing[(user_id, window)] = self._flushing.get((user_id, window), 0) + delta
+
+        shards = models.UsageCounter.__table__
+        stmt = sqlite_insert(shards)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[shards.c.user_id, shards.c.api_name, shards.c.shard],
+            set_={
+                "count": case(
+                    (shards.c.window_start.is_not_distinct_from(stmt.excluded.window_start), shards.c.count + stmt.excluded.count),
+                    else_=stmt.excluded.count,
+                ),
+                "window_start": stmt.excluded.window_start,
+            },
+            # Deltas for a window the shard has already moved past are dropped
+            where=func.coalesce(shards.c.window_start <= stmt.excluded.window_start, true()),
+        )
+        # Oldest window first, so a shard straddling a rollover ends in the new one
+        params = [
+            {"user_id": user_id, "api_name": api_name, "shard": counters.pick_shard(), "window_start": window, "count": delta}
+            for (user_id, api_name, window), delta in sorted(batch.items(), key=lambda item: item[0][2] or datetime.min)
+        ]
+
+        try:
+            async with database.AsyncSessionLocal() as db:
+                await db.execute(stmt, params)
+                await db.commit()
+        except Exception:
+            # Put the deltas back so the next flush retries them
+            with self._lock:
+                for (user_id, api_name, window), delta in batch.items():
+                    self._pending[(user_id, api_name, window)] += delta
+                    self._pending_totals[(user_id, window)] += delta
+                    self._buffered += delta
+            raise
+        finally:
+            with self._lock:
+                for (user_id, _, window), delta in batch.items():
+                    key = (user_id, window)
+                    remaining = self._flushing.get(key, 0) - delta
+                    if remaining > 0:
+                        self._flushing[key] = remaining
+                    else:
+                        self._flushing.pop(key, None)
+
+
+class UsageEventLog(BatchWriter):
+    """Buffers usage events and appends them in batches, updating the rollups"""
+
+    def __init__(self, flush_interval: float = 1.0, flush_threshold: int = 500):
+        super().__init__(flush_interval, flush_threshold)
+        self._events = []
+        self._lock = Lock()
+
+    async def record(self, user_id: int, api_name: str, count: int = 1):
+        """Buffer one event for ``count`` calls; flushes inline once the threshold is hit"""
+        created_at = datetime.now(timezone.utc).replace(tzinfo=None)
+        event = {"user_id": user_id, "api_name": api_name, "created_at": created_at, "count": count}
+        with self._lock:
+            self._events.append(event)
+            should_flush = len(self._events) >= self.flush_threshold
+        if should_flush:
+            await self.flush()
+
+    async def flush(self):
+        """Append buffered events and fold them into the minute and hour rollups"""
+        with self._lock:
+            if not self._events:
+                return
+            events, self._events = self._events, []
+
+        minutes = Counter()
+        hours = Counter()
+        for event in events:
+            minute = event["created_at"].replace(second=0, microsecond=0)
+            minutes[(event["user_id"], minute, event["api_name"])] += event["count"]
+            hours[(event["user_id"], minute.replace(minute=0), event["api_name"])] += event["count"]
+
+        try:
+            async with database.AsyncSessionLocal() as db:
+                await db.execute(insert(models.UsageEvent), events)
+                for model, buckets in ((models.UsageRollupMinute, minutes), (models.UsageRollupHour, hours)):
+                    stmt = sqlite_insert(model)
+                    stmt = stmt.on_conflict_do_update(
+                        index_elements=["user_id", "bucket_start", "api_name"],
+                        set_={"count": model.count + stmt.excluded.count},
+                    )
+                    await db.execute(stmt, [
+                        {"user_id": user_id, "bucket_start": bucket_start, "api_name": api_name, "count": count}
+                        for (user_id, bucket_start, api_name), count in buckets.items()
+                    ])
+                await db.commit()
+        except Exception:
+            # Keep the events so the next flush retries them
+            with self._lock:
+                self._events[:0] = events
+            raise
+
+
+usage_aggregator = UsageAggregator(
+    flush_interval=config.USAGE_FLUSH_INTERVAL,
+    flush_threshold=config.USAGE_FLUSH_THRESHOLD,
+)
+
+usage_event_log = UsageEventLog(
+    flush_interval=config.USAGE_FLUSH_INTERVAL,
+    flush_threshold=config.USAGE_FLUSH_THRESHOLD,
+)
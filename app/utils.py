@@ -1,19 +1,186 @@
-from fastapi import HTTPException
-from sqlalchemy.orm import Session
-from . import models
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional, Union
+from fastapi import Depends, HTTPException
+from sqlalchemy import bindparam, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from . import models, schemas, cache, metrics, database, services, counters, quota
+from .auth import get_current_user
+from .ratelimit import check_rate_limit
+from .usage import usage_aggregator, usage_event_log
 
-def check_usage_limit(db: Session, user: models.User, api_name: str):
-    if not user.subscription_plan:
-        raise HTTPException(status_code=403, detail="No active subscription")
+# Statements on the hot path are built once so every request reuses the same
+# compiled SQL from SQLAlchemy's statement cache
 
-    if user.usage_count >= user.subscription_plan.usage_limit:
-        raise HTTPException(status_code=403, detail="Usage limit reached")
+_PERMISSION_SEPARATOR = "\x1f"
+
+_user_entitlement_query = (
+    select(
+        models.User.id,
+        models.User.subscription_plan_id,
+        models.Plan.usage_limit,
+        models.Plan.rate_limit,
+        models.Plan.rate_limit_burst,
+        models.Plan.quota_period,
+        # Permissions folded into one row so the usage subquery runs once
+        func.group_concat(models.Permission.name, _PERMISSION_SEPARATOR).label("permissions"),
+        counters.usage_sum(models.User.id, counters.plan_window()).label("usage_count"),
+    )
+    .select_from(models.User)
+    .outerjoin(models.Plan, models.Plan.id == models.User.subscription_plan_id)
+    .outerjoin(models.plan_permissions, models.plan_permissions.c.plan_id == models.Plan.id)
+    .outerjoin(models.Permission, models.Permission.id == models.plan_permissions.c.permission_id)
+    .where(models.User.id == bindparam("b_user_id"))
+    .group_by(models.User.id)
+)
+
+@dataclass(frozen=True)
+class UserEntitlement:
+    """A user's stored usage together with their plan's entitlement"""
+    user_id: int
+    usage_count: int
+    entitlement: Optional[cache.Entitlement]
+    window_start: Optional[datetime] = None
+
+async def resolve_user_entitlement(db: AsyncSession, user_id: int) -> Optional[UserEntitlement]:
+    """Load a user, their plan, its permissions and the user's current usage in one query.
+
+    Returns None if the user doesn't exist. The plan's entitlement is also
+    stored in the entitlement cache.
+    """
+    generation = cache.entitlement_cache.generation
+    first = (await db.execute(_user_entitlement_query, {"b_user_id": user_id, **counters.window_params()})).first()
+    if first is None:
+        return None
+
+    entitlement = None
+    if first.usage_limit is not None:
+        entitlement = cache.Entitlement(
+            plan_id=first.subscription_plan_id,
+            permissions=frozenset(first.permissions.split(_PERMISSION_SEPARATOR)) if first.permissions else frozenset(),
+            usage_limit=first.usage_limit,
+            rate_limit=first.rate_limit,
+            rate_limit_burst=first.rate_limit_burst,
+            quota_period=first.quota_period,
+        )
+        cache.entitlement_cache.set(entitlement, generation)
+    window_start = entitlement.window_start() if entitlement else None
+    if quota.backend.counts_in_database:
+        usage_count = first.usage_count + usage_aggregator.pending(user_id, window_start)
+    else:
+        usage_count = await quota.backend.usage(db, first.id, window_start)
+    return UserEntitlement(user_id=first.id, usage_count=usage_count, entitlement=entitlement, window_start=window_start)
+
+async def load_user_entitlements(db: AsyncSession, user_ids) -> dict[int, Optional[cache.Entitlement]]:
+    """Entitlement of each existing user among ``user_ids`` (None without a plan).
+
+    One IN query for the users, and one for any of their plans not in the
+    entitlement cache.
+    """
+    plans = await quota.current_plans(db, set(user_ids))
+    entitlements = await cache.get_entitlements(db, {plan_id for plan_id in plans.values() if plan_id is not None})
+    loaded = {}
+    for user_id, plan_id in plans.items():
+        entitlement = entitlements.get(plan_id)
+        loaded[user_id] = entitlement if entitlement is not None and entitlement.usage_limit is not None else None
+    return loaded
+
+async def resolve_user_entitlements(db: AsyncSession, user_ids) -> dict[int, UserEntitlement]:
+    """Batch form of ``resolve_user_entitlement``, keyed by user ID; unknown users are left out.
+
+    Adds one usage read from the quota backend, for all of the users together,
+    to the queries of ``load_user_entitlements``.
+    """
+    entitlements = await load_user_entitlements(db, user_ids)
+    now = counters.utc_now()
+    resolved = [
+        (user_id, entitlement, entitlement.window_start(now) if entitlement else None)
+        for user_id, entitlement in entitlements.items()
+    ]
+    usage_counts = await quota.backend.usage_many(db, [(user_id, window_start) for user_id, _, window_start in resolved])
+    return {
+        user_id: UserEntitlement(user_id=user_id, usage_count=usage_count, entitlement=entitlement, window_start=window_start)
+        for (user_id, entitlement, window_start), usage_count in zip(resolved, usage_counts)
+    }
+
+_NO_SUBSCRIPTION = "No active subscription"
+_NOT_IN_PLAN = "API not included in subscription plan"
+_PLAN_CHANGED = "Subscription changed"
+_LIMIT_REACHED = "Usage limit reached"
+# Denials a stale plan claim in the token could explain; a reached limit is not one of them
+_STALE_PLAN_DENIALS = (_NO_SUBSCRIPTION, _NOT_IN_PLAN, _PLAN_CHANGED)
+
+async def charge_usage(
+    db: AsyncSession,
+    user_id: int,
+    entitlement: cache.Entitlement,
+    api_name: str
+) -> Optional[int]:
+    """Count one call to ``api_name`` against the user's quota for the current window.
+
+    The configured quota backend applies the charge, only while the user is still
+    on the entitlement's plan. Returns the new usage count, or None if the limit
+    was reached; raises ``quota.PlanChanged`` if the plan changed.
+    Successful charges are appended to the usage event log.
+    """
+    usage_count = await quota.backend.charge(db, user_id, entitlement, api_name)
+    if usage_count is not None:
+        await usage_event_log.record(user_id, api_name)
+    return usage_count
+
+async def _charge_entitlement(
+    db: AsyncSession,
+    user_id: int,
+    entitlement: Optional[cache.Entitlement],
+    api_name: str
+):
+    if entitlement is None:
+        raise HTTPException(status_code=403, detail=_NO_SUBSCRIPTION)
 
     # Check if the API is allowed in the user's plan
-    allowed_apis = user.subscription_plan.api_permissions.split(',')
-    if api_name not in allowed_apis:
-        raise HTTPException(status_code=403, detail="API not included in subscription plan")
+    if api_name not in entitlement.permissions:
+        raise HTTPException(status_code=403, detail=_NOT_IN_PLAN)
+
+    # Throttle bursts in memory before touching the database
+    check_rate_limit(user_id, api_name, entitlement.rate_limit, entitlement.rate_limit_burst)
+
+    try:
+        usage_count = await charge_usage(db, user_id, entitlement, api_name)
+    except quota.PlanChanged:
+        raise HTTPException(status_code=403, detail=_PLAN_CHANGED)
+    if usage_count is None:
+        raise HTTPException(status_code=403, detail=_LIMIT_REACHED)
+
+async def check_usage_limit(db: AsyncSession, user: Union[models.User, schemas.TokenData], api_name: str):
+    try:
+        await _check_and_charge(db, user, api_name)
+    except HTTPException as e:
+        metrics.quota_denials.inc((e.detail,))
+        raise
+
+async def _check_and_charge(db: AsyncSession, user, api_name: str):
+    # Fast path: plan from the token, entitlement from the cache, one quota charge
+    entitlement = await cache.get_entitlement(db, user.subscription_plan_id)
+    try:
+        await _charge_entitlement(db, user.id, entitlement, api_name)
+    except HTTPException as e:
+        if e.detail not in _STALE_PLAN_DENIALS:
+            raise
+        # The plan claimed by the token may be stale; re-check against the stored subscription
+        resolved = await resolve_user_entitlement(db, user.id)
+        stored_plan_id = resolved.entitlement.plan_id if resolved and resolved.entitlement else None
+        if resolved is None or stored_plan_id == user.subscription_plan_id:
+            raise
+        await _charge_entitlement(db, user.id, resolved.entitlement, api_name)
 
-    # Increment usage count
-    user.usage_count += 1
-    db.commit()
+async def require_registered_service(
+    service_name: str,
+    current_user: schemas.TokenData = Depends(get_current_user),
+    db: AsyncSession = Depends(database.get_async_session)
+) -> services.ServiceInfo:
+    """Dependency for ``/api/{service_name}``: look the service up, authorize the caller and charge one call"""
+    service = services.registry.get(service_name)
+    if service is None or not service.enabled:
+        raise HTTPException(status_code=404, detail="Service not found")
+    await check_usage_limit(db, current_user, service.name)
+    return service
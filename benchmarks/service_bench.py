@@ -0,0 +1,177 @@
+"""Load and latency benchmark for the service endpoints.
+
+Drives the app in-process through httpx's ASGI transport against a scratch
+database, seeded with users subscribed to an unlimited plan, and reports
+throughput and p50/p95/p99 latency per scenario.
+
+    python -m benchmarks.service_bench --requests 2000 --concurrency 32 --save baseline.json
+    python -m benchmarks.service_bench --compare baseline.json --threshold 0.15
+
+With --compare the run exits non-zero when any scenario's throughput drops,
+or its p95 latency grows, by more than the threshold.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import secrets
+import statistics
+import sys
+import tempfile
+import time
+
+SERVICES = ["storage", "compute", "database", "analytics", "ai", "messaging"]
+SCENARIOS = ["services", "usage", "access", "token"]
+
+
+def percentile(quantiles: list[float], p: int) -> float:
+    return quantiles[p - 1] * 1000
+
+
+async def run_scenario(client, name: str, requests: int, concurrency: int, users: list[dict]) -> dict:
+    from app import config
+    counter = itertools.count()
+    latencies = []
+    errors = 0
+    ingest_headers = {"X-Ingest-Key": config.USAGE_INGEST_KEYS[0]}
+
+    def build(i: int):
+        user = users[i % len(users)]
+        api_name = SERVICES[i % len(SERVICES)]
+        if name == "services":
+            return client.get(f"/api/{api_name}", headers=user["headers"])
+        if name == "usage":
+            return client.post(f"/usage/{user['id']}", json={"api_name": api_name}, headers=ingest_headers)
+        if name == "access":
+            return client.get(f"/access/{user['id']}/{api_name}")
+        return client.post("/token", data={"username": user["username"], "password": user["password"]})
+
+    async def worker():
+        nonlocal errors
+        while (i := next(counter)) < requests:
+            started = time.perf_counter()
+            response = await build(i)
+            latencies.append(time.perf_counter() - started)
+            if response.status_code >= 400:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    quantiles = statistics.quantiles(latencies, n=100)
+    return {
+        "requests": requests,
+        "errors": errors,
+        "seconds": elapsed,
+        "throughput": requests / elapsed,
+        "p50_ms": percentile(quantiles, 50),
+        "p95_ms": percentile(quantiles, 95),
+        "p99_ms": percentile(quantiles, 99),
+    }
+
+
+async def run(args) -> dict:
+    import httpx
+    from sqlalchemy import insert
+    from app import auth, database, models
+    from app.main import app
+
+    async with app.router.lifespan_context(app):
+        # One real hash shared by every user, so the token scenario measures verification
+        hashed_password = auth.pwd_context.hash("bench")
+        async with database.AsyncSessionLocal() as db:
+            from app import crud
+            plan_id = (await db.execute(insert(models.Plan).returning(models.Plan.id), {
+                "name": "Benchmark Plan",
+                "description": "Unlimited access for benchmarking",
+                "api_permissions": ",".join(SERVICES),
+                "usage_limit": 10**12,
+            })).scalar()
+            await db.execute(insert(models.User), [
+                {"username": f"bench{i}", "hashed_password": hashed_password, "subscription_plan_id": plan_id}
+                for i in range(args.users)
+            ])
+            await db.commit()
+            await crud.migrate_plan_permissions(db)
+            users = []
+            for i in range(args.users):
+                user = await crud.get_user_by_username(db, f"bench{i}")
+                users.append({
+                    "id": user.id,
+                    "username": user.username,
+                    "password": "bench",
+                    "headers": {"Authorization": f"Bearer {auth.create_access_token(user)}"},
+                })
+
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            results = {}
+            for name in args.scenarios:
+                # Warm caches and connections before measuring
+                await run_scenario(client, name, min(args.requests, 100), args.concurrency, users)
+                results[name] = await run_scenario(client, name, args.requests, args.concurrency, users)
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    failures = []
+    for name, result in results.items():
+        base = baseline["scenarios"].get(name)
+        if base is None:
+            continue
+        if result["throughput"] < base["throughput"] * (1 - threshold):
+            failures.append(f"{name}: throughput {result['throughput']:.0f}/s vs baseline {base['throughput']:.0f}/s")
+        if result["p95_ms"] > base["p95_ms"] * (1 + threshold):
+            failures.append(f"{name}: p95 {result['p95_ms']:.2f}ms vs baseline {base['p95_ms']:.2f}ms")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.15, help="allowed relative regression")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Point the app at a scratch database before it is imported
+        os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        os.environ.pop("ASYNC_DATABASE_URL", None)
+        os.environ.setdefault("SECRET_KEY", secrets.token_urlsafe(32))
+        os.environ.setdefault("USAGE_INGEST_KEYS", secrets.token_urlsafe(32))
+        results = asyncio.run(run(args))
+
+    print(f"{'scenario':<10}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, result in results.items():
+        print(f"{name:<10}{result['requests']:>10}{result['errors']:>8}{result['throughput']:>10.0f}"
+              f"{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}{result['p99_ms']:>10.2f}")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({
+                "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "python": platform.python_version(),
+                "settings": {"requests": args.requests, "concurrency": args.concurrency, "users": args.users},
+                "scenarios": results,
+            }, f, indent=2)
+        print(f"saved results to {args.save}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            failures = compare(results, json.load(f), args.threshold)
+        for failure in failures:
+            print(f"REGRESSION {failure}")
+        if failures:
+            sys.exit(1)
+        print(f"no regressions beyond {args.threshold:.0%}")
+
+
+if __name__ == "__main__":
+    main()
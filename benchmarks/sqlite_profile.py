@@ -0,0 +1,75 @@
+"""Compare the "default" and "tuned" SQLite engine profiles from app/database.py.
+
+Seeds a scratch database, then runs a mixed workload from several threads:
+user lookups plus the usage counter upsert used by the service endpoints,
+one commit per write.
+
+    python -m benchmarks.sqlite_profile --ops 20000 --threads 8
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import select, insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from app import database, models
+
+
+def run_profile(profile: str, path: str, users: int, ops: int, threads: int, write_ratio: float) -> dict:
+    engine = database.create_db_engine(f"sqlite:///{path}", profile=profile)
+    database.Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        conn.execute(insert(models.Plan), [{"name": "bench", "description": "", "api_permissions": "", "usage_limit": 10**9}])
+        conn.execute(insert(models.User), [
+            {"username": f"user{i}", "hashed_password": "", "subscription_plan_id": 1}
+            for i in range(users)
+        ])
+
+    def worker(count: int):
+        rng = random.Random()
+        with engine.connect() as conn:
+            for _ in range(count):
+                user_id = rng.randint(1, users)
+                if rng.random() < write_ratio:
+                    stmt = sqlite_insert(models.UsageCounter).values(user_id=user_id, api_name="bench", shard=0, count=1)
+                    conn.execute(stmt.on_conflict_do_update(
+                        index_elements=["user_id", "api_name", "shard"],
+                        set_={"count": models.UsageCounter.count + 1},
+                    ))
+                    conn.commit()
+                else:
+                    conn.execute(select(models.User).where(models.User.id == user_id)).first()
+                    conn.rollback()
+
+    per_thread = ops // threads
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(worker, [per_thread] * threads))
+    elapsed = time.perf_counter() - started
+    engine.dispose()
+    return {"profile": profile, "ops": per_thread * threads, "seconds": elapsed, "ops_per_second": per_thread * threads / elapsed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--ops", type=int, default=20000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--write-ratio", type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = []
+    for profile in ("default", "tuned"):
+        with tempfile.TemporaryDirectory() as tmp:
+            results.append(run_profile(profile, os.path.join(tmp, "bench.db"), args.users, args.ops, args.threads, args.write_ratio))
+
+    print(f"{'profile':<10}{'ops':>10}{'seconds':>10}{'ops/s':>12}")
+    for result in results:
+        print(f"{result['profile']:<10}{result['ops']:>10}{result['seconds']:>10.2f}{result['ops_per_second']:>12.0f}")
+    print(f"speedup: {results[1]['ops_per_second'] / results[0]['ops_per_second']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+import asyncio
+import json
+import pytest
+from app.ingest import MalformedStream, iter_json_array, iter_ndjson
+
+ARRAY_BODY = '[{"user_id": 1, "api_name": "storage", "count": 2}, 1.5, 2e3, -0.25, 10, true, null, "été", []]'.encode()
+
+
+async def _chunks(chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+def _parse(parser, chunks) -> list:
+    async def collect():
+        return [value async for value in parser(_chunks(chunks))]
+    return asyncio.run(collect())
+
+
+@pytest.mark.parametrize("split", range(1, len(ARRAY_BODY)))
+def test_json_array_any_chunk_boundary(split):
+    chunks = [ARRAY_BODY[:split], ARRAY_BODY[split:]]
+    assert _parse(iter_json_array, chunks) == json.loads(ARRAY_BODY)
+
+
+def test_json_array_byte_by_byte():
+    chunks = [ARRAY_BODY[i:i + 1] for i in range(len(ARRAY_BODY))]
+    assert _parse(iter_json_array, chunks) == json.loads(ARRAY_BODY)
+
+
+@pytest.mark.parametrize("chunks", [
+    [b'[{"user_id": 1}, 1.', b'5]'],
+    [b'[2e', b'3]'],
+    [b'[-', b'1]'],
+    [b'[12', b'34 ', b']'],
+])
+def test_json_array_number_split_across_chunks(chunks):
+    assert _parse(iter_json_array, chunks) == json.loads(b"".join(chunks))
+
+
+@pytest.mark.parametrize("body", [b"[1 2]", b'{"user_id": 1}', b"[1.]", b"[1,", b"[1] 2"])
+def test_json_array_malformed(body):
+    with pytest.raises(MalformedStream):
+        _parse(iter_json_array, [body])
+
+
+def test_ndjson_lines_split_across_chunks():
+    chunks = [b'{"user_id": 1, "api_na', b'me": "storage"}\n\nnot json\n{"user_id": 2,', b' "api_name": "ai"}']
+    assert _parse(iter_ndjson, chunks) == [
+        {"user_id": 1, "api_name": "storage"},
+        None,
+        {"user_id": 2, "api_name": "ai"},
+    ]
@@ -0,0 +1,71 @@
+import asyncio
+import shutil
+import sqlite3
+from pathlib import Path
+from app import database, migrations, quota
+
+# The database committed with the original project, from before schema versioning
+BASELINE_DB = Path(__file__).resolve().parent.parent / "test.db"
+
+
+def _upgrade(path) -> bool:
+    async def main():
+        engine = database.create_async_db_engine(f"sqlite+aiosqlite:///{path}")
+        try:
+            return await migrations.upgrade_schema(engine)
+        finally:
+            await engine.dispose()
+    return asyncio.run(main())
+
+
+def _schema(path) -> dict:
+    """Columns of every table and the SQL of every named index"""
+    with sqlite3.connect(path) as conn:
+        tables = [name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        return {
+            "columns": {table: sorted(row[1] for row in conn.execute(f"PRAGMA table_info({table})")) for table in tables},
+            "indexes": dict(conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL")),
+        }
+
+
+def test_baseline_database_upgrades_to_the_fresh_schema(tmp_path):
+    upgraded = tmp_path / "baseline.db"
+    shutil.copyfile(BASELINE_DB, upgraded)
+    fresh = tmp_path / "fresh.db"
+
+    assert _upgrade(upgraded) is True
+    assert _upgrade(fresh) is True
+    assert _schema(upgraded) == _schema(fresh)
+
+    with sqlite3.connect(upgraded) as conn:
+        assert conn.execute("SELECT version FROM schema_version").fetchall() == [(migrations.SCHEMA_VERSION,)]
+        assert conn.execute("SELECT count(*) FROM services").fetchone() == (6,)
+
+
+def test_baseline_usage_is_carried_over(tmp_path):
+    upgraded = tmp_path / "baseline.db"
+    shutil.copyfile(BASELINE_DB, upgraded)
+    with sqlite3.connect(f"file:{BASELINE_DB}?mode=ro", uri=True) as conn:
+        usage_before = dict(conn.execute("SELECT id, usage_count FROM users"))
+
+    _upgrade(upgraded)
+
+    async def read_usage():
+        engine = database.create_async_db_engine(f"sqlite+aiosqlite:///{upgraded}")
+        try:
+            async with engine.connect() as conn:
+                return await quota.DatabaseQuotaBackend().usage_many(conn, [(user_id, None) for user_id in usage_before])
+        finally:
+            await engine.dispose()
+
+    assert asyncio.run(read_usage()) == list(usage_before.values())
+
+
+def test_upgrade_is_a_no_op_once_current(tmp_path):
+    upgraded = tmp_path / "baseline.db"
+    shutil.copyfile(BASELINE_DB, upgraded)
+    _upgrade(upgraded)
+    schema = _schema(upgraded)
+
+    assert _upgrade(upgraded) is False
+    assert _schema(upgraded) == schema
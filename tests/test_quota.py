@@ -0,0 +1,111 @@
+import asyncio
+from datetime import datetime
+import pytest
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from app import cache, counters, database, migrations, models, quota
+
+BACKENDS = ["database", "shared_memory", "redis"]
+
+
+def _run(tmp_path, backend_name, scenario):
+    """Run ``scenario(backend, sessions, user_id, plan_id)`` against a scratch database and backend"""
+    async def main():
+        engine = database.create_async_db_engine(f"sqlite+aiosqlite:///{tmp_path / 'quota.db'}", profile="tuned")
+        await migrations.upgrade_schema(engine)
+        sessions = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
+        async with sessions() as db:
+            plan_id = (await db.execute(insert(models.Plan).returning(models.Plan.id), {"name": "Test", "usage_limit": 0})).scalar()
+            user_id = (await db.execute(insert(models.User).returning(models.User.id), {
+                "username": "quota", "hashed_password": "unused", "subscription_plan_id": plan_id,
+            })).scalar()
+            await db.commit()
+
+        if backend_name == "shared_memory":
+            backend = quota.SharedMemoryQuotaBackend(str(tmp_path / "quota.shm"), 64)
+        elif backend_name == "redis":
+            backend = quota.RedisQuotaBackend("inprocess", pool_size=8)
+        else:
+            backend = quota.DatabaseQuotaBackend()
+        await backend.start()
+        try:
+            return await scenario(backend, sessions, user_id, plan_id)
+        finally:
+            await backend.close()
+            await engine.dispose()
+
+    return asyncio.run(main())
+
+
+def _entitlement(plan_id, usage_limit, quota_period=None):
+    return cache.Entitlement(plan_id=plan_id, permissions=frozenset({"storage"}), usage_limit=usage_limit, quota_period=quota_period)
+
+
+@pytest.mark.parametrize("backend_name", BACKENDS)
+def test_concurrent_charges_stop_exactly_at_the_limit(tmp_path, backend_name):
+    limit = 10
+
+    async def scenario(backend, sessions, user_id, plan_id):
+        entitlement = _entitlement(plan_id, limit)
+
+        async def charge():
+            async with sessions() as db:
+                return await backend.charge(db, user_id, entitlement, "storage")
+
+        results = await asyncio.gather(*(charge() for _ in range(limit * 3)))
+        async with sessions() as db:
+            return results, await backend.usage(db, user_id, None)
+
+    results, usage = _run(tmp_path, backend_name, scenario)
+    granted = [count for count in results if count is not None]
+    assert sorted(granted) == list(range(1, limit + 1))
+    assert usage == limit
+
+
+@pytest.mark.parametrize("backend_name", BACKENDS)
+def test_charge_many_grants_only_up_to_the_limit(tmp_path, backend_name):
+    async def scenario(backend, sessions, user_id, plan_id):
+        entitlement = _entitlement(plan_id, 10)
+        async with sessions() as db:
+            first = await backend.charge_many(db, [(user_id, entitlement, "storage", 7)])
+            second = await backend.charge_many(db, [(user_id, entitlement, "storage", 7)])
+            return first, second, await backend.charge(db, user_id, entitlement, "storage")
+
+    first, second, single = _run(tmp_path, backend_name, scenario)
+    assert first == [(7, 7)]
+    assert second == [(3, 10)]
+    assert single is None
+
+
+# In the future, so the Redis stand-in does not expire the keys of the earlier window
+@pytest.mark.parametrize("backend_name", BACKENDS)
+@pytest.mark.parametrize("quota_period, before, after", [
+    ("daily", datetime(2099, 3, 14, 23, 59, 59), datetime(2099, 3, 15, 0, 0, 1)),
+    ("monthly", datetime(2099, 3, 31, 23, 59, 59), datetime(2099, 4, 1, 0, 0, 1)),
+])
+def test_usage_restarts_when_the_window_rolls_over(tmp_path, monkeypatch, backend_name, quota_period, before, after):
+    clock = [before]
+    monkeypatch.setattr(counters, "utc_now", lambda: clock[0])
+
+    async def scenario(backend, sessions, user_id, plan_id):
+        entitlement = _entitlement(plan_id, 2, quota_period)
+        async with sessions() as db:
+            charged = [await backend.charge(db, user_id, entitlement, "storage") for _ in range(3)]
+            clock[0] = after
+            charged.append(await backend.charge(db, user_id, entitlement, "storage"))
+            return charged, await backend.usage(db, user_id, entitlement.window_start())
+
+    charged, usage = _run(tmp_path, backend_name, scenario)
+    assert charged == [1, 2, None, 1]
+    assert usage == 1
+
+
+@pytest.mark.parametrize("backend_name", BACKENDS)
+def test_charge_on_a_changed_plan_raises(tmp_path, backend_name):
+    async def scenario(backend, sessions, user_id, plan_id):
+        async with sessions() as db:
+            with pytest.raises(quota.PlanChanged):
+                await backend.charge(db, user_id, _entitlement(plan_id + 1, 10), "storage")
+            return await backend.charge_many(db, [(user_id, _entitlement(plan_id + 1, 10), "storage", 1)])
+
+    assert _run(tmp_path, backend_name, scenario) == [(0, None)]